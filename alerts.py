@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from api import subscribe_rates_changed
+from config import OUTBOX_ALERT_TTL
+from database import (
+    add_listener, enqueue_outbox, get_all_thresholds, get_user_thresholds, mark_thresholds_alerted,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ThresholdIndex:
+    """Пороговые значения, отсортированные по значению отдельно для каждой валюты
+
+    Пересеченные пороги находятся двумя бинарными поисками: O(log n + k)
+    на валюту вместо перебора всех пользователей.
+    """
+
+    def __init__(self):
+        # Валюта -> параллельные списки (значения по возрастанию, ID порогов)
+        self._values: Dict[str, List[float]] = {}
+        self._ids: Dict[str, List[int]] = {}
+        # ID -> (user_id, валюта, значение, комментарий, дата последнего оповещения)
+        self.thresholds: Dict[int, List] = {}
+
+    def __len__(self) -> int:
+        return len(self.thresholds)
+
+    def currencies(self) -> List[str]:
+        return list(self._values)
+
+    def add(self, threshold_id: int, user_id: int, currency: str, value: float,
+            comment: Optional[str], last_alert_date: Optional[str] = None):
+        """Добавление порога в индекс"""
+        if threshold_id in self.thresholds:
+            self.remove(threshold_id)
+        values = self._values.setdefault(currency, [])
+        ids = self._ids.setdefault(currency, [])
+        pos = bisect_right(values, value)
+        values.insert(pos, value)
+        ids.insert(pos, threshold_id)
+        self.thresholds[threshold_id] = [user_id, currency, value, comment, last_alert_date]
+
+    def remove(self, threshold_id: int):
+        """Удаление порога из индекса"""
+        entry = self.thresholds.pop(threshold_id, None)
+        if entry is None:
+            return
+        currency, value = entry[1], entry[2]
+        values, ids = self._values[currency], self._ids[currency]
+        lo, hi = bisect_left(values, value), bisect_right(values, value)
+        pos = ids.index(threshold_id, lo, hi)
+        del values[pos]
+        del ids[pos]
+        if not values:
+            del self._values[currency]
+            del self._ids[currency]
+
+    def remove_users(self, user_ids: List[int]):
+        """Удаление всех порогов пользователей"""
+        users = set(user_ids)
+        for threshold_id in [tid for tid, entry in self.thresholds.items() if entry[0] in users]:
+            self.remove(threshold_id)
+
+    def crossed(self, currency: str, previous: float, current: float) -> List[int]:
+        """ID порогов, пересеченных при движении курса от previous к current
+
+        Рост: previous <= порог < current; падение: current < порог <= previous.
+        """
+        values = self._values.get(currency)
+        if not values or previous == current:
+            return []
+        if current > previous:
+            lo, hi = bisect_left(values, previous), bisect_left(values, current)
+        else:
+            lo, hi = bisect_right(values, current), bisect_right(values, previous)
+        return self._ids[currency][lo:hi]
+
+
+_index = ThresholdIndex()
+_started = False
+
+
+def get_threshold_index() -> ThresholdIndex:
+    """Текущий индекс пороговых значений"""
+    return _index
+
+
+def _crossed_alerts(snapshot: Mapping) -> List[Tuple[int, int, str]]:
+    """Оповещения по снимку курсов: (ID порога, user_id, текст), без уже отправленных"""
+    rates_date = snapshot.get("as_of")
+    alerts = []
+    for currency in _index.currencies():
+        data = snapshot["rates"].get(currency)
+        if not data or not data.get("value") or data.get("previous") is None:
+            continue
+        curr_val = data["value"]
+        prev_val = data["previous"]
+        for tid in _index.crossed(currency, prev_val, curr_val):
+            user_id, _, tval, comment, last_alert_date = _index.thresholds[tid]
+            if rates_date and last_alert_date == rates_date:
+                continue
+            text = f"⚠️ {currency} достиг порогового значения {tval}!\nТекущий курс: {curr_val:.2f}"
+            if comment:
+                text += f"\nКомментарий: {comment}"
+            alerts.append((tid, user_id, text))
+    return alerts
+
+
+async def check_thresholds(snapshot: Mapping) -> int:
+    """Проверка всех порогов по снимку курсов и постановка оповещений в outbox"""
+    if not _started:
+        return 0
+    alerts = _crossed_alerts(snapshot)
+    if not alerts:
+        return 0
+    rates_date = snapshot.get("as_of")
+    logger.info(f"Rates {rates_date}: {len(alerts)} thresholds crossed")
+
+    # Ключ идемпотентности (порог + дата курсов) и отметка last_alert_date:
+    # повторная проверка того же снимка или рестарт не дублируют оповещение
+    expires_at = int(time.time()) + OUTBOX_ALERT_TTL
+    added = await enqueue_outbox([
+        (f"alert:{tid}:{rates_date}", user_id, "alert", text, expires_at) for tid, user_id, text in alerts
+    ])
+    claimed = [tid for tid, _, _ in alerts]
+    for tid in claimed:
+        # Порог могли удалить, пока шла запись в outbox (его уже убрал listener threshold_deleted)
+        entry = _index.thresholds.get(tid)
+        if entry is not None:
+            entry[4] = rates_date
+    await mark_thresholds_alerted(claimed, rates_date)
+    return added
+
+
+async def _on_rates_changed(old: Optional[Mapping], new: Mapping):
+    """Подписчик api: новый снимок курсов сразу проверяется по индексу порогов"""
+    await check_thresholds(new)
+
+
+async def _load_user_thresholds(user_id: int):
+    """Возврат порогов пользователя в индекс после повторного включения"""
+    try:
+        for tid, currency, value, comment in await get_user_thresholds(user_id):
+            _index.add(tid, user_id, currency, value, comment)
+    except Exception as e:
+        logger.error(f"Error loading thresholds for user {user_id}: {e}", exc_info=True)
+
+
+async def start_threshold_engine():
+    """Загрузка порогов из БД в индекс и подписка на изменения порогов и курсов"""
+    global _started
+    _started = True
+    for tid, user_id, currency, value, comment, last_alert_date in await get_all_thresholds():
+        _index.add(tid, user_id, currency, value, comment, last_alert_date)
+    logger.info(f"Threshold engine loaded {len(_index)} thresholds for {len(_index.currencies())} currencies")
+
+    add_listener("threshold_added", _index.add)
+    add_listener("threshold_deleted", _index.remove)
+    # Пороги отключенных пользователей (бот заблокирован) не проверяются
+    add_listener("users_deactivated", _index.remove_users)
+    add_listener("user_reactivated", lambda user_id: asyncio.create_task(_load_user_thresholds(user_id)))
+    subscribe_rates_changed(_on_rates_changed)
@@ -1,57 +1,218 @@
+import asyncio
 import aiohttp
-from datetime import datetime, date
-import xml.etree.ElementTree as ET
+import hashlib
+import json
+from datetime import datetime, date, timedelta
+from types import MappingProxyType
 import logging
-from typing import Dict, List, Tuple, Optional
-from config import CBR_URL, CBR_ARCHIVE_URL, CBR_VALFULL_URL, CBR_DYNAMIC_URL
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Tuple, Optional
+from config import (
+    CBR_TIMEZONE, CBR_PUBLICATION_WINDOW, RATES_CACHE_TTL, RATES_CACHE_TTL_PUBLICATION, RATES_STALE_WAIT,
+    RATES_POLL_INTERVAL, RATES_POLL_INTERVAL_PUBLICATION,
+    CURRENCY_DIRECTORY_REFRESH_INTERVAL, CURRENCY_DIRECTORY_MISS_REFRESH_INTERVAL,
+    HISTORY_RECHECK_INTERVAL,
+)
+from database import (
+    get_archived_rates, save_archived_rates, get_currency_directory, save_currency_directory,
+    get_historical_coverage, get_historical_rates, save_historical_rates,
+)
+from http_client import close_session
+from metrics import add_collector, API_CACHE_EVENTS, API_CACHE_HIT_RATIO
+from providers import RateProvider, CBRProvider
 
 logger = logging.getLogger(__name__)
 
-# Глобальная сессия для переиспользования соединений
-_session: Optional[aiohttp.ClientSession] = None
+# Источник данных: по умолчанию ЦБ РФ, для тестов и нагрузочных замеров - любой RateProvider
+_provider: RateProvider = CBRProvider()
 
+# Общий неизменяемый снимок текущих курсов и время его устаревания (UTC)
+_rates_cache: Optional[Mapping] = None
+_rates_cache_expires: Optional[datetime] = None
 
-async def get_session() -> aiohttp.ClientSession:
-    """Получение или создание глобальной HTTP-сессии"""
-    global _session
-    if _session is None or _session.closed:
-        timeout = aiohttp.ClientTimeout(total=30)
-        headers = {"User-Agent": "ExchangeRateBot/1.0"}
-        _session = aiohttp.ClientSession(timeout=timeout, headers=headers)
-    return _session
+# Валидаторы для условных запросов (ETag / Last-Modified) и отпечаток содержимого снимка
+_rates_validators: Dict[str, str] = {}
+_rates_fingerprint: Optional[str] = None
 
+# Подписчики на событие "курсы изменились": async callback(old_snapshot, new_snapshot)
+_rates_listeners: List[Callable[[Optional[Mapping], Mapping], Awaitable[None]]] = []
 
-async def close_session():
-    """Закрытие глобальной HTTP-сессии"""
-    global _session
-    if _session and not _session.closed:
-        await _session.close()
-        _session = None
+# Выполняющиеся запросы к API: повторные вызовы с тем же ключом ждут один запрос
+_inflight: Dict[str, asyncio.Future] = {}
 
+# Счетчики попаданий и промахов кеша
+_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "coalesced": 0, "stale": 0, "not_modified": 0}
+_archive_stats: Dict[str, int] = {"hits": 0, "misses": 0, "coalesced": 0}
 
-async def fetch_all_rates() -> Dict:
-    """Получение текущих курсов валют"""
+# Справочник валют ЦБ (ISO-код -> ID) и время его последнего обновления (UTC)
+_currency_ids: Dict[str, str] = {}
+_currency_ids_updated: Optional[datetime] = None
+
+
+async def _single_flight(key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """Объединение одновременных запросов с одинаковым ключом в один"""
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(factory())
+        _inflight[key] = fut
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+        # Ошибку логирует factory; ожидающих к этому моменту может уже не быть
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+    # shield: отмена одного ожидающего не должна прерывать общий запрос
+    return await asyncio.shield(fut)
+
+
+def _in_publication_window(now: datetime) -> bool:
+    """Проверка, что сейчас (UTC) идет окно публикации новых курсов ЦБ"""
+    msk_now = now + timedelta(hours=CBR_TIMEZONE)
+    start_hour, end_hour = CBR_PUBLICATION_WINDOW
+    return msk_now.isoweekday() <= 5 and start_hour <= msk_now.hour < end_hour
+
+
+def _rates_cache_expiry(now: datetime) -> datetime:
+    """Вычисление момента устаревания снимка курсов с учетом окна публикации ЦБ"""
+    if _in_publication_window(now):
+        return now + timedelta(seconds=RATES_CACHE_TTL_PUBLICATION)
+
+    expires = now + timedelta(seconds=RATES_CACHE_TTL)
+    # Не держим старый снимок дольше начала ближайшего окна публикации
+    msk_now = now + timedelta(hours=CBR_TIMEZONE)
+    start_hour = CBR_PUBLICATION_WINDOW[0]
+    window_start = msk_now.replace(hour=start_hour, minute=0, second=0, microsecond=0)
+    if window_start <= msk_now:
+        window_start += timedelta(days=1)
+    return min(expires, window_start - timedelta(hours=CBR_TIMEZONE))
+
+
+def get_provider() -> RateProvider:
+    """Получение текущего источника курсов"""
+    return _provider
+
+
+def set_provider(provider: RateProvider):
+    """Замена источника курсов (например, на локальный тестовый сервер)"""
+    global _provider
+    _provider = provider
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Получение счетчиков кешей: попадания, промахи, запросы, дождавшиеся чужой загрузки,
+    ответы устаревшим снимком и ответы 304"""
+    return {"rates": dict(_cache_stats), "archive": dict(_archive_stats)}
+
+
+async def _collect_cache_metrics():
+    """Перенос счетчиков кешей в метрики перед выдачей /metrics"""
+    for cache, stats in get_cache_stats().items():
+        for result, count in stats.items():
+            API_CACHE_EVENTS.labels(cache, result).set(count)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"] + stats.get("stale", 0)
+        # Скачивание - только промах; объединенные запросы и устаревший снимок его не вызывают
+        API_CACHE_HIT_RATIO.labels(cache).set((lookups - stats["misses"]) / lookups if lookups else 0)
+
+
+add_collector(_collect_cache_metrics)
+
+
+def subscribe_rates_changed(callback: Callable[[Optional[Mapping], Mapping], Awaitable[None]]):
+    """Подписка на публикацию снимка курсов с изменившимся содержимым"""
+    _rates_listeners.append(callback)
+
+
+async def fetch_all_rates() -> Mapping:
+    """Получение текущих курсов валют (из общего снимка с TTL)
+
+    Если снимок устарел, обновление ждется не дольше RATES_STALE_WAIT: затем
+    отдается прежний снимок с пометкой stale, а запрос к API продолжается в фоне.
+    """
+    now = datetime.utcnow()
+    if _rates_cache is not None and _rates_cache_expires is not None and now < _rates_cache_expires:
+        _cache_stats["hits"] += 1
+        return _rates_cache
+
+    # Пока API недоступен, сразу отдаем последний удачный снимок с пометкой stale
+    if _rates_cache is not None and not _provider.is_available():
+        _cache_stats["stale"] += 1
+        return {**_rates_cache, "stale": True}
+
+    if "rates" in _inflight:
+        _cache_stats["coalesced"] += 1
+    else:
+        _cache_stats["misses"] += 1
+    if _rates_cache is None:
+        return await _single_flight("rates", _refresh_rates)
     try:
-        session = await get_session()
-        async with session.get(CBR_URL, timeout=aiohttp.ClientTimeout(total=20)) as resp:
-            if resp.status != 200:
-                logger.error(f"CBR API returned status {resp.status}")
-                raise ValueError(f"API returned status {resp.status}")
-
-            data = await resp.json(content_type=None)
-            date_str = datetime.strptime(data["Date"], "%Y-%m-%dT%H:%M:%S%z").strftime("%d.%m")
-            rates = {}
-            for code, v in data["Valute"].items():
-                value = v["Value"]
-                nominal = v["Nominal"]
-                prev = v.get("Previous")
-                rates[code] = {
-                    "value": value,
-                    "nominal": nominal,
-                    "previous": prev
-                }
-            logger.info(f"Fetched {len(rates)} exchange rates")
-            return {"base": "RUB", "date": date_str, "rates": rates}
+        # Повторы и таймауты запроса к API не должны задерживать ответ на десятки секунд
+        return await asyncio.wait_for(_single_flight("rates", _refresh_rates), RATES_STALE_WAIT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Rates refresh is taking longer than {RATES_STALE_WAIT}s, serving stale snapshot")
+        _cache_stats["stale"] += 1
+        return {**_rates_cache, "stale": True}
+    except Exception:
+        logger.warning("Serving stale rates snapshot after fetch failure")
+        _cache_stats["stale"] += 1
+        return {**_rates_cache, "stale": True}
+
+
+def _parse_daily_json(data: Dict) -> Tuple[Mapping, str]:
+    """Преобразование daily_json в неизменяемый снимок и отпечаток его содержимого"""
+    rates_date = datetime.strptime(data["Date"], "%Y-%m-%dT%H:%M:%S%z").date()
+    date_str = rates_date.strftime("%d.%m")
+    rates = {}
+    for code, v in data["Valute"].items():
+        rates[code] = MappingProxyType({
+            "value": v["Value"],
+            "nominal": v["Nominal"],
+            "previous": v.get("Previous")
+        })
+    # Timestamp меняется при каждой перегенерации файла, поэтому в отпечаток не входит
+    fingerprint = hashlib.sha256(
+        json.dumps([data["Date"], data["Valute"]], sort_keys=True).encode()
+    ).hexdigest()
+    snapshot = MappingProxyType({
+        "base": "RUB", "date": date_str, "as_of": rates_date.isoformat(), "rates": MappingProxyType(rates)
+    })
+    return snapshot, fingerprint
+
+
+def _publish_rates(snapshot: Mapping, fingerprint: str):
+    """Публикация нового снимка; подписчики уведомляются только об изменении содержимого"""
+    global _rates_cache, _rates_cache_expires, _rates_fingerprint
+    old = _rates_cache
+    _rates_cache = snapshot
+    _rates_cache_expires = _rates_cache_expiry(datetime.utcnow())
+    if fingerprint == _rates_fingerprint:
+        return
+    _rates_fingerprint = fingerprint
+    logger.info(f"Rates snapshot changed: {snapshot['date']}, {len(snapshot['rates'])} currencies")
+    for callback in _rates_listeners:
+        asyncio.create_task(_notify_rates_listener(callback, old, snapshot))
+
+
+async def _notify_rates_listener(callback: Callable, old: Optional[Mapping], new: Mapping):
+    """Вызов подписчика с логированием ошибок"""
+    try:
+        await callback(old, new)
+    except Exception as e:
+        logger.error(f"Rates listener {callback.__name__} failed: {e}", exc_info=True)
+
+
+async def _refresh_rates() -> Mapping:
+    """Условный запрос текущих курсов: при 304 продлевается текущий снимок"""
+    global _rates_cache_expires, _rates_validators
+    validators = _rates_validators if _rates_cache is not None else {}
+    try:
+        data, new_validators = await _provider.fetch_current(validators)
+        if data is None:
+            _cache_stats["not_modified"] += 1
+            _rates_cache_expires = _rates_cache_expiry(datetime.utcnow())
+            logger.debug("Rates not modified (304)")
+            return _rates_cache
+
+        _rates_validators = new_validators
+        snapshot, fingerprint = _parse_daily_json(data)
+        _publish_rates(snapshot, fingerprint)
+        logger.info(f"Fetched {len(snapshot['rates'])} exchange rates")
+        return snapshot
     except aiohttp.ClientError as e:
         logger.error(f"Network error fetching rates: {e}", exc_info=True)
         raise
@@ -60,29 +221,87 @@ async def fetch_all_rates() -> Dict:
         raise
 
 
+async def refresh_rates() -> Mapping:
+    """Внеочередное обновление снимка курсов (условным запросом)"""
+    return await _single_flight("rates", _refresh_rates)
+
+
+async def warm_rates(valid_until: datetime, currencies: Iterable[str] = ()):
+    """Прогрев снимка курсов: после вызова он действителен как минимум до valid_until (UTC)"""
+    global _rates_cache_expires
+    fresh = _rates_cache is not None and _rates_cache_expires is not None and _rates_cache_expires >= valid_until
+    missing = [c for c in currencies if _rates_cache is None or c not in _rates_cache["rates"]]
+    if fresh and not missing:
+        return
+
+    await refresh_rates()
+    # Снимок только что проверен: держим его до пика рассылки, даже если TTL короче
+    if _rates_cache_expires is not None and _rates_cache_expires < valid_until:
+        _rates_cache_expires = valid_until
+    unknown = [c for c in missing if c not in _rates_cache["rates"]]
+    if unknown:
+        logger.warning(f"Currencies not present in CBR rates: {', '.join(unknown)}")
+
+
+async def rates_poller_loop():
+    """Фоновый опрос daily_json условными запросами"""
+    while True:
+        try:
+            await refresh_rates()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Rates poll failed: {e}")
+        if _in_publication_window(datetime.utcnow()):
+            await asyncio.sleep(RATES_POLL_INTERVAL_PUBLICATION)
+        else:
+            await asyncio.sleep(RATES_POLL_INTERVAL)
+
+
+async def _load_archived_valute(dt: date) -> Dict:
+    """Получение архивных курсов за дату: сначала из БД, затем из API"""
+    date_iso = dt.isoformat()
+    try:
+        cached = await get_archived_rates(date_iso)
+    except Exception:
+        cached = None
+    if cached is not None:
+        _archive_stats["hits"] += 1
+        return cached
+
+    _archive_stats["misses"] += 1
+    valute = await _provider.fetch_archive(dt)
+
+    # Курсы за прошедшие даты не меняются - сохраняем их навсегда
+    today_msk = (datetime.utcnow() + timedelta(hours=CBR_TIMEZONE)).date()
+    if dt < today_msk:
+        try:
+            await save_archived_rates(date_iso, valute)
+        except Exception:
+            pass
+    return valute
+
+
 async def fetch_rates_by_date(dt: date, currencies: List[str]) -> Dict:
     """Получение курсов валют за конкретную дату"""
-    url = CBR_ARCHIVE_URL.format(year=dt.year, month=dt.month, day=dt.day)
     try:
-        session = await get_session()
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=20)) as resp:
-            if resp.status != 200:
-                logger.warning(f"No data for date {dt}: status {resp.status}")
-                raise ValueError("Нет данных за эту дату")
-            data = await resp.json(content_type=None)
-            rates = {}
-            for code in currencies:
-                v = data["Valute"].get(code)
-                if not v:
-                    rates[code] = {"value": None, "nominal": 1, "previous": None}
-                else:
-                    rates[code] = {
-                        "value": v["Value"],
-                        "nominal": v["Nominal"],
-                        "previous": v.get("Previous"),
-                    }
-            logger.info(f"Fetched rates for {len(currencies)} currencies on {dt}")
-            return {"base": "RUB", "date": dt.strftime("%d.%m.%Y"), "rates": rates}
+        key = f"archive:{dt.isoformat()}"
+        if key in _inflight:
+            _archive_stats["coalesced"] += 1
+        valute = await _single_flight(key, lambda: _load_archived_valute(dt))
+        rates = {}
+        for code in currencies:
+            v = valute.get(code)
+            if not v:
+                rates[code] = {"value": None, "nominal": 1, "previous": None}
+            else:
+                rates[code] = {
+                    "value": v["Value"],
+                    "nominal": v["Nominal"],
+                    "previous": v.get("Previous"),
+                }
+        logger.info(f"Fetched rates for {len(currencies)} currencies on {dt}")
+        return {"base": "RUB", "date": dt.strftime("%d.%m.%Y"), "rates": rates}
     except aiohttp.ClientError as e:
         logger.error(f"Network error fetching rates for {dt}: {e}")
         return {
@@ -99,95 +318,164 @@ async def fetch_rates_by_date(dt: date, currencies: List[str]) -> Dict:
         }
 
 
-async def fetch_rates(currencies: List[str]) -> Dict:
-    """Получение курсов валют для списка валют"""
-    try:
-        all_data = await fetch_all_rates()
-        rates = {c: all_data["rates"].get(c) for c in currencies}
-        return {"base": "RUB", "date": all_data["date"], "rates": rates}
-    except Exception as e:
-        logger.error(f"Error fetching rates for currencies {currencies}: {e}", exc_info=True)
-        now = datetime.utcnow()
+def select_rates(snapshot: Optional[Mapping], currencies: List[str]) -> Dict:
+    """Курсы выбранных валют из снимка fetch_all_rates (None - снимка нет, значения пустые)"""
+    if snapshot is None:
         return {
             "base": "RUB",
-            "date": now.strftime("%d.%m"),
+            "date": datetime.utcnow().strftime("%d.%m"),
             "rates": {c: {"value": None, "nominal": 1} for c in currencies}
         }
+    rates = {c: snapshot["rates"].get(c) for c in currencies}
+    return {"base": "RUB", "date": snapshot["date"], "rates": rates, "stale": snapshot.get("stale", False)}
 
 
-async def get_currency_id(currency: str) -> str:
-    """Получение ID валюты из справочника ЦБ РФ"""
+async def fetch_rates_snapshot() -> Optional[Mapping]:
+    """Снимок текущих курсов или None, если его не удалось получить"""
     try:
-        session = await get_session()
-        async with session.get(CBR_VALFULL_URL, timeout=aiohttp.ClientTimeout(total=20)) as resp:
-            if resp.status != 200:
-                logger.error(f"Failed to fetch currency directory: status {resp.status}")
-                raise ValueError("Не удалось загрузить справочник валют")
-
-            xml_text = await resp.text()
-            try:
-                root = ET.fromstring(xml_text)
-            except ET.ParseError as e:
-                logger.error(f"Invalid XML response from currency directory: {e}")
-                raise ValueError("Получен некорректный ответ от API")
-
-            for item in root.findall('Item'):
-                char_code = item.find('ISO_Char_Code')
-                if char_code is not None and char_code.text == currency:
-                    return item.get('ID')
-
-            logger.warning(f"Currency {currency} not found in directory")
-            raise ValueError(f"Валюта {currency} не найдена в справочнике")
-    except aiohttp.ClientError as e:
-        logger.error(f"Network error fetching currency ID for {currency}: {e}")
-        raise
+        return await fetch_all_rates()
+    except Exception as e:
+        logger.error(f"Error fetching rates snapshot: {e}", exc_info=True)
+        return None
 
 
-async def fetch_historical_data(currency: str, start_date: date, end_date: date) -> List[Tuple[date, float]]:
-    """Получение исторических данных по валюте"""
+async def fetch_rates(currencies: List[str]) -> Dict:
+    """Получение курсов валют для списка валют"""
+    return select_rates(await fetch_rates_snapshot(), currencies)
+
+
+async def load_currency_directory():
+    """Загрузка сохраненного справочника валют из БД при старте"""
+    global _currency_ids, _currency_ids_updated
+    try:
+        directory, updated_at = await get_currency_directory()
+    except Exception:
+        return
+    if directory:
+        _currency_ids = directory
+        _currency_ids_updated = datetime.strptime(updated_at, "%Y-%m-%d %H:%M:%S")
+        logger.info(f"Loaded currency directory from DB: {len(directory)} currencies")
+
+
+async def _refresh_currency_directory() -> Dict[str, str]:
+    """Загрузка справочника валют и замена им текущего"""
+    global _currency_ids, _currency_ids_updated
+    directory = {}
+    async for char_code, item_id in _provider.iter_directory():
+        directory.setdefault(char_code, item_id)
+    if not directory:
+        raise ValueError("Получен пустой справочник валют")
+    _currency_ids = directory
+    _currency_ids_updated = datetime.utcnow()
     try:
-        currency_id = await get_currency_id(currency)
-        url = (
-            f"{CBR_DYNAMIC_URL}?"
-            f"date_req1={start_date.strftime('%d/%m/%Y')}&"
-            f"date_req2={end_date.strftime('%d/%m/%Y')}&"
-            f"VAL_NM_RQ={currency_id}"
+        await save_currency_directory(directory)
+    except Exception:
+        pass
+    logger.info(f"Currency directory refreshed: {len(directory)} currencies")
+    return directory
+
+
+async def refresh_currency_directory() -> Dict[str, str]:
+    """Обновление справочника валют из API с сохранением в БД"""
+    return await _single_flight("directory", _refresh_currency_directory)
+
+
+async def currency_directory_loop():
+    """Фоновое периодическое обновление справочника валют"""
+    while True:
+        try:
+            if _currency_ids_updated is None:
+                delay = 0
+            else:
+                age = (datetime.utcnow() - _currency_ids_updated).total_seconds()
+                delay = max(0, CURRENCY_DIRECTORY_REFRESH_INTERVAL - age)
+            await asyncio.sleep(delay)
+            await refresh_currency_directory()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to refresh currency directory: {e}", exc_info=True)
+            await asyncio.sleep(CURRENCY_DIRECTORY_MISS_REFRESH_INTERVAL)
+
+
+async def get_currency_id(currency: str) -> str:
+    """Получение ID валюты из справочника ЦБ РФ"""
+    currency_id = _currency_ids.get(currency)
+    if currency_id:
+        return currency_id
+
+    # Промах: обновляем справочник, но не чаще CURRENCY_DIRECTORY_MISS_REFRESH_INTERVAL
+    stale = (
+        _currency_ids_updated is None or
+        (datetime.utcnow() - _currency_ids_updated).total_seconds() >= CURRENCY_DIRECTORY_MISS_REFRESH_INTERVAL
+    )
+    if stale:
+        try:
+            await refresh_currency_directory()
+        except aiohttp.ClientError as e:
+            logger.error(f"Network error fetching currency ID for {currency}: {e}")
+            raise
+        currency_id = _currency_ids.get(currency)
+        if currency_id:
+            return currency_id
+
+    logger.warning(f"Currency {currency} not found in directory")
+    raise ValueError(f"Валюта {currency} не найдена в справочнике")
+
+
+async def _download_historical_data(currency: str, start_date: date, end_date: date) -> List[Tuple[date, float]]:
+    """Загрузка исторических данных по валюте из API"""
+    currency_id = await get_currency_id(currency)
+    data = [record async for record in _provider.iter_dynamics(currency_id, start_date, end_date)]
+    logger.info(f"Fetched {len(data)} historical records for {currency} ({start_date} — {end_date})")
+    return data
+
+
+def _missing_history_ranges(
+    coverage: Optional[Tuple[str, str, str]], start_date: date, end_date: date
+) -> List[Tuple[date, date]]:
+    """Вычисление диапазонов дат, которых нет в локальном хранилище"""
+    if coverage is None:
+        return [(start_date, end_date)]
+
+    cov_start = date.fromisoformat(coverage[0])
+    cov_end = date.fromisoformat(coverage[1])
+    # Диапазоны догружаются вплотную к уже загруженному, чтобы покрытие оставалось непрерывным
+    ranges = []
+    if start_date < cov_start:
+        ranges.append((start_date, cov_start - timedelta(days=1)))
+
+    # Последние дни ряда перепроверяем не чаще HISTORY_RECHECK_INTERVAL:
+    # курс на завтра ЦБ публикует заранее, и он мог появиться после прошлой загрузки
+    tail_from = cov_end + timedelta(days=1)
+    recent = date.today() - timedelta(days=1)
+    if cov_end >= recent and coverage[2]:
+        checked_at = datetime.strptime(coverage[2], "%Y-%m-%d %H:%M:%S")
+        if (datetime.utcnow() - checked_at).total_seconds() >= HISTORY_RECHECK_INTERVAL:
+            tail_from = min(tail_from, recent)
+    if tail_from <= end_date:
+        ranges.append((tail_from, end_date))
+    return ranges
+
+
+async def _fill_history_gaps(currency: str, start_date: date, end_date: date):
+    """Загрузка из API только отсутствующих в хранилище диапазонов"""
+    coverage = await get_historical_coverage(currency)
+    for gap_start, gap_end in _missing_history_ranges(coverage, start_date, end_date):
+        records = await _download_historical_data(currency, gap_start, gap_end)
+        await save_historical_rates(
+            currency, gap_start.isoformat(), gap_end.isoformat(),
+            [(dt.isoformat(), value) for dt, value in records]
         )
 
-        session = await get_session()
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-            if resp.status != 200:
-                logger.error(f"Failed to fetch historical data: status {resp.status}")
-                raise ValueError("Не удалось загрузить исторические данные")
-
-            xml_text = await resp.text()
-            try:
-                root = ET.fromstring(xml_text)
-            except ET.ParseError as e:
-                logger.error(f"Invalid XML in historical data response: {e}")
-                raise ValueError("Получен некорректный ответ от API")
-
-            data = []
-            for record in root.findall('Record'):
-                date_str = record.get('Date')
-                try:
-                    nominal_elem = record.find('Nominal')
-                    value_elem = record.find('Value')
-
-                    if nominal_elem is None or value_elem is None:
-                        continue
-
-                    nominal = int(nominal_elem.text)
-                    value_str = value_elem.text.replace(',', '.')
-                    value = float(value_str)
-                    dt = datetime.strptime(date_str, "%d.%m.%Y").date()
-                    data.append((dt, value / nominal))
-                except (AttributeError, ValueError, TypeError) as e:
-                    logger.warning(f"Skipping invalid record for date {date_str}: {e}")
-                    continue
-
-            logger.info(f"Fetched {len(data)} historical records for {currency}")
-            return data
+
+async def fetch_historical_data(currency: str, start_date: date, end_date: date) -> List[Tuple[date, float]]:
+    """Получение исторических данных по валюте (из локального хранилища с догрузкой пропусков)"""
+    try:
+        key = f"history:{currency}:{start_date.isoformat()}:{end_date.isoformat()}"
+        await _single_flight(key, lambda: _fill_history_gaps(currency, start_date, end_date))
+        rows = await get_historical_rates(currency, start_date.isoformat(), end_date.isoformat())
+        return [(date.fromisoformat(d), value) for d, value in rows]
     except Exception as e:
         logger.error(f"Error fetching historical data for {currency}: {e}", exc_info=True)
-        raise
\ No newline at end of file
+        raise
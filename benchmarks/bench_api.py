@@ -0,0 +1,74 @@
+"""
+Замер кешей и пропускной способности api.py на фейковом сервере ЦБ
+
+    python benchmarks/bench_api.py --concurrency 1000 --latency 0.2
+
+Для каждого сценария печатается число запросов к серверу и время выполнения
+холодного (пустой кеш) и теплого (данные уже в кеше) прохода.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_api_"), "bench.db")
+
+import api  # noqa: E402
+from database import init_db, close_db  # noqa: E402
+from providers import CBRProvider  # noqa: E402
+from fake_cbr import start_server, urls  # noqa: E402
+
+
+async def _timed(label: str, stats: dict, coro_factory, concurrency: int):
+    """Запуск concurrency одновременных вызовов и печать результата"""
+    before = stats["requests"]
+    started = time.perf_counter()
+    await asyncio.gather(*[coro_factory() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    print(f"{label:<40} {concurrency:>6} calls  {stats['requests'] - before:>4} upstream  {elapsed * 1000:>9.1f} ms")
+
+
+async def run(args):
+    runner = await start_server(latency=args.latency, currencies=args.currencies)
+    host, port = runner.addresses[0][:2]
+    api.set_provider(CBRProvider(**urls(f"http://{host}:{port}")))
+    stats = runner.app["stats"]
+    await init_db()
+
+    end = date.today()
+    start = end - timedelta(days=364)
+    past = end - timedelta(days=30)
+    while not 2 <= past.isoweekday() <= 6:
+        past -= timedelta(days=1)
+
+    try:
+        await _timed("fetch_rates (cold)", stats, lambda: api.fetch_rates(["USD", "EUR"]), args.concurrency)
+        await _timed("fetch_rates (warm)", stats, lambda: api.fetch_rates(["USD", "EUR"]), args.concurrency)
+        await _timed("fetch_rates_by_date (cold)", stats, lambda: api.fetch_rates_by_date(past, ["USD"]), args.concurrency)
+        await _timed("fetch_rates_by_date (warm)", stats, lambda: api.fetch_rates_by_date(past, ["USD"]), args.concurrency)
+        await _timed("fetch_historical_data 365d (cold)", stats,
+                     lambda: api.fetch_historical_data("USD", start, end), args.concurrency // 10 or 1)
+        await _timed("fetch_historical_data 365d (warm)", stats,
+                     lambda: api.fetch_historical_data("USD", start, end), args.concurrency // 10 or 1)
+        print(f"cache stats: {api.get_cache_stats()}")
+    finally:
+        await api.close_session()
+        await close_db()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк кешей api.py")
+    parser.add_argument("--concurrency", type=int, default=500, help="Одновременных вызовов на сценарий")
+    parser.add_argument("--latency", type=float, default=0.1, help="Задержка фейкового сервера, секунды")
+    parser.add_argument("--currencies", type=int, default=43, help="Число валют в ответах")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Сравнение отрисовщиков графиков статистики: Pillow (chart_pil.py) и matplotlib
+
+    python benchmarks/bench_charts.py --runs 20
+
+Каждый отрисовщик замеряется в отдельном процессе: время импорта, первого
+и последующих графиков (7, 30 и 365 дней) и пиковый RSS процесса.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+
+PERIODS = (7, 30, 365)
+
+
+def _series(days: int):
+    """Рабочие дни периода со случайным блужданием курса"""
+    start = date(2024, 1, 1)
+    dates, values, value = [], [], 90.0
+    for i in range(days):
+        day = start + timedelta(days=i)
+        value += ((i * 7919) % 13 - 6) * 0.1
+        if day.isoweekday() <= 5:
+            dates.append(day)
+            values.append(round(value, 4))
+    return tuple(dates), tuple(values)
+
+
+def _max_rss_mib() -> float:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux - КиБ, macOS - байты
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def worker(renderer: str, runs: int):
+    """Замер одного отрисовщика (запускается в отдельном процессе)"""
+    baseline = _max_rss_mib()
+    started = time.perf_counter()
+    from charts import ChartSpec, get_renderer
+    render = get_renderer(renderer)
+    if renderer == "matplotlib":
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot  # noqa: F401
+    else:
+        import chart_pil  # noqa: F401
+    import_ms = (time.perf_counter() - started) * 1000
+
+    result = {"renderer": renderer, "import_ms": import_ms, "periods": {}}
+    for days in PERIODS:
+        dates, values = _series(days)
+        spec = ChartSpec(dates, values, f"Курс USD к RUB за {days} дней\n(Данные ЦБ РФ, бенчмарк)")
+        timings, size = [], 0
+        for _ in range(runs):
+            started = time.perf_counter()
+            size = len(render(spec))
+            timings.append((time.perf_counter() - started) * 1000)
+        result["periods"][days] = {
+            "first_ms": timings[0], "median_ms": statistics.median(timings[1:] or timings), "png_kib": size / 1024,
+        }
+    result["rss_mib"] = _max_rss_mib()
+    result["rss_growth_mib"] = result["rss_mib"] - baseline
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Графиков на каждый период")
+    parser.add_argument("--renderers", default="pil,matplotlib")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.runs)
+        return
+
+    print(f"{'renderer':<12} {'import':>9} {'period':>7} {'first':>9} {'median':>9} {'png':>9} {'max RSS':>9}")
+    for renderer in args.renderers.split(","):
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", renderer, "--runs", str(args.runs)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"{renderer:<12} failed: {proc.stderr.strip().splitlines()[-1] if proc.stderr else proc.returncode}")
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        for i, (days, r) in enumerate(result["periods"].items()):
+            head = f"{renderer:<12} {result['import_ms']:>7.0f}ms" if i == 0 else f"{'':<12} {'':>9}"
+            tail = f" {result['rss_mib']:>6.1f}MiB" if i == 0 else ""
+            print(f"{head} {days:>6}d {r['first_ms']:>7.1f}ms {r['median_ms']:>7.1f}ms {r['png_kib']:>6.0f}KiB{tail}")
+
+
+if __name__ == "__main__":
+    main()
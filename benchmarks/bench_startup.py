@@ -0,0 +1,141 @@
+"""
+Замер холодного старта процесса бота по режимам (BOT_MODE)
+
+    python benchmarks/bench_startup.py --runs 3 --profile
+
+Каждый запуск - отдельный процесс: время импорта main.py, время до готовности
+к первому обновлению (start_services: БД, бот, обработчики, фоновые задачи),
+init_db на новой и на уже созданной базе и пиковый RSS. С --profile для
+каждого режима печатаются самые долгие импорты (python -X importtime).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ("bot", "scheduler")
+
+
+def _max_rss_mib() -> float:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux - КиБ, macOS - байты
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def worker(mode: str):
+    """Один холодный старт (запускается в отдельном процессе)"""
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+    sys.path.insert(0, ROOT)
+    result = {"mode": mode}
+
+    started = time.perf_counter()
+    import main
+    result["import_main_ms"] = (time.perf_counter() - started) * 1000
+    result["import_rss_mib"] = _max_rss_mib()
+
+    async def run():
+        import database
+        # Схема создается заранее: замер init_db на новой и на текущей базе
+        t = time.perf_counter()
+        await database.init_db()
+        result["init_db_new_ms"] = (time.perf_counter() - t) * 1000
+        await database.close_db()
+        t = time.perf_counter()
+        await database.init_db()
+        result["init_db_current_ms"] = (time.perf_counter() - t) * 1000
+        await database.close_db()
+
+        t = time.perf_counter()
+        await main.start_services(mode in ("all", "bot"), mode in ("all", "scheduler"))
+        result["ready_ms"] = (time.perf_counter() - t) * 1000 + result["import_main_ms"]
+        result["ready_rss_mib"] = _max_rss_mib()
+        await main.shutdown()
+
+    asyncio.run(run())
+    print(json.dumps(result))
+
+
+def _env(mode: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": env.get("BOT_TOKEN") or "123456:benchmark",
+        "BOT_MODE": mode,
+        "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bench_startup_"), "bench.db"),
+        "METRICS_PORT": "0",
+        # Фоновые задачи не должны ходить в сеть во время замера
+        "CBR_URL": "http://127.0.0.1:9/daily_json.js",
+        "CBR_VALFULL_URL": "http://127.0.0.1:9/XML_valFull.asp",
+    })
+    return env
+
+
+def profile(mode: str, top: int):
+    """Самые долгие импорты режима по суммарному времени"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--worker", mode],
+        capture_output=True, text=True, env=_env(mode),
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), name.rstrip()))
+    # Только импорты верхнего уровня вложенности (без их подмодулей)
+    rows = [(us, name) for us, name in rows if len(name) - len(name.lstrip()) <= 3]
+    print(f"\nTop imports for BOT_MODE={mode}:")
+    for us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {us / 1000:>8.1f} ms  {name.strip()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Холодных стартов на режим")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--profile", action="store_true", help="Печатать самые долгие импорты")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker)
+        return
+
+    print(f"{'mode':<10} {'import main':>12} {'ready':>9} {'init_db new':>12} {'init_db cur':>12} "
+          f"{'RSS import':>11} {'RSS ready':>10}")
+    for mode in args.modes.split(","):
+        results = []
+        for _ in range(args.runs):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", mode],
+                capture_output=True, text=True, env=_env(mode),
+            )
+            if proc.returncode != 0:
+                print(f"{mode:<10} failed: {proc.stderr.strip().splitlines()[-1] if proc.stderr else proc.returncode}")
+                break
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        if not results:
+            continue
+
+        def med(key: str) -> float:
+            return statistics.median(r[key] for r in results)
+
+        print(f"{mode:<10} {med('import_main_ms'):>10.0f}ms {med('ready_ms'):>7.0f}ms "
+              f"{med('init_db_new_ms'):>10.1f}ms {med('init_db_current_ms'):>10.1f}ms "
+              f"{med('import_rss_mib'):>8.1f}MiB {med('ready_rss_mib'):>7.1f}MiB")
+
+    if args.profile:
+        for mode in args.modes.split(","):
+            profile(mode, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Замер сводки по ряду курсов (stats.py): NumPy против циклов на Python
+
+    python benchmarks/bench_stats.py --sizes 30,365,2500,25000
+
+Для каждого размера ряда (рабочие дни) печатается время summarize() по спискам
+(как из api.fetch_historical_data), по уже готовым массивам NumPy и эквивалентной
+реализации на циклах; результаты сверяются между собой.
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats import as_array, day_numbers, summarize  # noqa: E402
+
+
+def _series(size: int):
+    """Рабочие дни начиная с 2000 года со случайным блужданием курса"""
+    dates, values, day, value, i = [], [], date(2000, 1, 3), 30.0, 0
+    while len(dates) < size:
+        if day.isoweekday() <= 5:
+            value *= 1 + ((i * 7919) % 201 - 100) / 10000
+            dates.append(day)
+            values.append(value)
+            i += 1
+        day += timedelta(days=1)
+    return dates, values
+
+
+def summarize_loops(values, dates):
+    """Та же сводка циклами: эталон для сверки и сравнения скорости"""
+    n = len(values)
+    first, last = values[0], values[-1]
+    mean = sum(values) / n
+    returns = [values[i] / values[i - 1] - 1 for i in range(1, n)]
+    if len(returns) > 1:
+        r_mean = sum(returns) / len(returns)
+        vol = math.sqrt(sum((r - r_mean) ** 2 for r in returns) / (len(returns) - 1))
+    else:
+        vol = 0.0
+    peak, drawdown = values[0], 0.0
+    for v in values:
+        peak = max(peak, v)
+        drawdown = max(drawdown, (peak - v) / peak)
+
+    def moving_average(window):
+        # Календарное окно, как stats.moving_average с dates
+        if (dates[-1] - dates[0]).days + 1 < window:
+            return None
+        start = dates[-1] - timedelta(days=window - 1)
+        window_values = [v for d, v in zip(dates, values) if d >= start]
+        return sum(window_values) / len(window_values)
+
+    return {
+        "min": min(values), "max": max(values), "mean": mean, "change_pct": (last - first) / first * 100,
+        "volatility_pct": vol * 100, "max_drawdown_pct": drawdown * 100,
+        "ma7": moving_average(7), "ma30": moving_average(30),
+    }
+
+
+def _timed(fn, runs: int) -> float:
+    """Медианное время вызова, мс"""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="30,365,2500,25000", help="Длины рядов через запятую")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'points':>8} {'numpy':>10} {'arrays':>10} {'loops':>10} {'speedup':>8}  match")
+    for size in map(int, args.sizes.split(",")):
+        dates, values = _series(size)
+        fast = summarize(values, dates)._asdict()
+        slow = summarize_loops(values, dates)
+        match = all(
+            (fast[k] is None and slow[k] is None) or math.isclose(fast[k], slow[k], rel_tol=1e-9, abs_tol=1e-9)
+            for k in slow
+        )
+        values_array, days_array = as_array(values), day_numbers(dates)
+        numpy_ms = _timed(lambda: summarize(values, dates), args.runs)
+        arrays_ms = _timed(lambda: summarize(values_array, days_array), args.runs)
+        loops_ms = _timed(lambda: summarize_loops(values, dates), args.runs)
+        print(f"{size:>8} {numpy_ms:>8.3f}ms {arrays_ms:>8.3f}ms {loops_ms:>8.3f}ms "
+              f"{loops_ms / numpy_ms:>7.1f}x  {'ok' if match else 'MISMATCH'}")
+
+
+if __name__ == "__main__":
+    main()
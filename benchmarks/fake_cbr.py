@@ -0,0 +1,253 @@
+"""
+Локальный сервер, имитирующий API ЦБ РФ (daily_json, архив, XML_valFull, XML_dynamic)
+
+Отдает синтетические (детерминированные) или записанные ответы с настраиваемой
+задержкой, долей ошибок и размером ответа. Используется для нагрузочных замеров
+и проверки кешей без обращений к настоящему ЦБ:
+
+    python benchmarks/fake_cbr.py --port 8081 --latency 0.2 --error-rate 0.05
+
+и затем запуск бота с переменными окружения, которые печатает сервер (CBR_URL и т.д.).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+# Коды реальных валют ЦБ; при --currencies больше длины списка добавляются синтетические
+KNOWN_CODES = [
+    "AUD", "AZN", "GBP", "AMD", "BYN", "BGN", "BRL", "HUF", "VND", "HKD", "GEL", "DKK",
+    "AED", "USD", "EUR", "EGP", "INR", "IDR", "KZT", "CAD", "QAR", "KGS", "CNY", "MDL",
+    "NZD", "NOK", "PLN", "RON", "XDR", "SGD", "TJS", "THB", "TRY", "TMT", "UZS", "UAH",
+    "CZK", "SEK", "CHF", "RSD", "ZAR", "KRW", "JPY",
+]
+# Валюты, курс которых ЦБ публикует не за 1 единицу
+NOMINALS = {"HUF": 100, "VND": 10000, "IDR": 10000, "KZT": 100, "KGS": 10, "AMD": 100,
+            "JPY": 100, "KRW": 1000, "UZS": 10000, "TJS": 10, "UAH": 10, "RSD": 100,
+            "CZK": 10, "SEK": 10, "NOK": 10, "DKK": 10, "HKD": 10, "INR": 10, "THB": 10,
+            "EGP": 10, "ZAR": 10}
+
+EPOCH = date(2000, 1, 1)
+
+
+def _codes(count: int) -> List[str]:
+    """Список кодов валют заданной длины"""
+    codes = KNOWN_CODES[:count]
+    codes += [f"X{i:02d}" for i in range(count - len(codes))]
+    return codes
+
+
+def _currency_id(code: str) -> str:
+    """Детерминированный внутренний ID валюты в стиле ЦБ"""
+    return "R0" + str(int(hashlib.md5(code.encode()).hexdigest(), 16) % 10000).zfill(4)
+
+
+def _is_rate_day(dt: date) -> bool:
+    """ЦБ устанавливает курсы со вторника по субботу"""
+    return 2 <= dt.isoweekday() <= 6
+
+
+def _rate(code: str, dt: date) -> float:
+    """Синтетический курс за номинал: плавная детерминированная кривая"""
+    seed = int(hashlib.md5(code.encode()).hexdigest(), 16)
+    base = 1 + seed % 150
+    day = (dt - EPOCH).days
+    wave = 0.08 * math.sin(day / 37 + seed % 7) + 0.03 * math.sin(day / 5 + seed % 3)
+    return round(base * NOMINALS.get(code, 1) * (1 + wave), 4)
+
+
+def _previous_rate_day(dt: date) -> date:
+    """Ближайшая предыдущая дата установки курса"""
+    dt -= timedelta(days=1)
+    while not _is_rate_day(dt):
+        dt -= timedelta(days=1)
+    return dt
+
+
+def _daily_json(dt: date, count: int) -> Dict:
+    """Ответ в формате daily_json.js за дату"""
+    prev = _previous_rate_day(dt)
+    valute = {}
+    for i, code in enumerate(_codes(count)):
+        valute[code] = {
+            "ID": _currency_id(code),
+            "NumCode": f"{i:03d}",
+            "CharCode": code,
+            "Nominal": NOMINALS.get(code, 1),
+            "Name": f"Валюта {code}",
+            "Value": _rate(code, dt),
+            "Previous": _rate(code, prev),
+        }
+    return {
+        "Date": f"{dt.isoformat()}T11:30:00+03:00",
+        "PreviousDate": f"{prev.isoformat()}T11:30:00+03:00",
+        "Timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+        "Valute": valute,
+    }
+
+
+def _valfull_xml(count: int) -> bytes:
+    """Ответ в формате XML_valFull.asp"""
+    items = "".join(
+        f'<Item ID="{_currency_id(code)}"><Name>Валюта {code}</Name><EngName>Currency {code}</EngName>'
+        f'<Nominal>{NOMINALS.get(code, 1)}</Nominal><ParentCode>{_currency_id(code)}    </ParentCode>'
+        f'<ISO_Num_Code>{i}</ISO_Num_Code><ISO_Char_Code>{code}</ISO_Char_Code></Item>'
+        for i, code in enumerate(_codes(count))
+    )
+    xml = f'<?xml version="1.0" encoding="windows-1251"?><Valuta name="Foreign Currency Market Lib">{items}</Valuta>'
+    return xml.encode("cp1251")
+
+
+def _dynamic_xml(currency_id: str, start: date, end: date, count: int) -> bytes:
+    """Ответ в формате XML_dynamic.asp за период"""
+    code = next((c for c in _codes(count) if _currency_id(c) == currency_id), None)
+    records = []
+    dt = start
+    while code and dt <= end:
+        if _is_rate_day(dt):
+            value = f"{_rate(code, dt):.4f}".replace(".", ",")
+            records.append(
+                f'<Record Date="{dt.strftime("%d.%m.%Y")}" Id="{currency_id}">'
+                f'<Nominal>{NOMINALS.get(code, 1)}</Nominal><Value>{value}</Value></Record>'
+            )
+        dt += timedelta(days=1)
+    xml = (
+        f'<?xml version="1.0" encoding="windows-1251"?><ValCurs ID="{currency_id}" '
+        f'DateRange1="{start.strftime("%d.%m.%Y")}" DateRange2="{end.strftime("%d.%m.%Y")}" '
+        f'name="Foreign Currency Market Dynamic">{"".join(records)}</ValCurs>'
+    )
+    return xml.encode("cp1251")
+
+
+def create_app(latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+               currencies: int = len(KNOWN_CODES), recorded_dir: Optional[str] = None,
+               publish_interval: float = 0.0) -> web.Application:
+    """Создание приложения фейкового сервера ЦБ
+
+    publish_interval > 0 сдвигает "сегодняшнюю" дату курсов каждые N секунд,
+    имитируя публикацию новых курсов.
+    """
+    started = time.monotonic()
+    stats = {"requests": 0, "errors": 0, "not_modified": 0}
+
+    def current_rate_day() -> date:
+        dt = date.today()
+        if publish_interval > 0:
+            dt += timedelta(days=int((time.monotonic() - started) // publish_interval))
+        while not _is_rate_day(dt):
+            dt -= timedelta(days=1)
+        return dt
+
+    @web.middleware
+    async def faults(request: web.Request, handler):
+        stats["requests"] += 1
+        if latency or jitter:
+            await asyncio.sleep(latency + random.uniform(0, jitter))
+        if error_rate and random.random() < error_rate:
+            stats["errors"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        if recorded_dir:
+            path = os.path.join(recorded_dir, request.path.lstrip("/"))
+            if os.path.isfile(path):
+                return web.FileResponse(path)
+        return await handler(request)
+
+    async def daily(request: web.Request) -> web.Response:
+        dt = current_rate_day()
+        etag = f'"{dt.isoformat()}-{currencies}"'
+        if request.headers.get("If-None-Match") == etag:
+            stats["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        body = json.dumps(_daily_json(dt, currencies), ensure_ascii=False)
+        return web.Response(text=body, content_type="application/javascript", headers={"ETag": etag})
+
+    async def archive(request: web.Request) -> web.Response:
+        try:
+            dt = date(int(request.match_info["year"]), int(request.match_info["month"]),
+                      int(request.match_info["day"]))
+        except ValueError:
+            raise web.HTTPNotFound()
+        if not _is_rate_day(dt) or dt > current_rate_day():
+            raise web.HTTPNotFound()
+        body = json.dumps(_daily_json(dt, currencies), ensure_ascii=False)
+        return web.Response(text=body, content_type="application/javascript")
+
+    async def valfull(request: web.Request) -> web.Response:
+        return web.Response(body=_valfull_xml(currencies), content_type="application/xml")
+
+    async def dynamic(request: web.Request) -> web.Response:
+        try:
+            start = datetime.strptime(request.query["date_req1"], "%d/%m/%Y").date()
+            end = datetime.strptime(request.query["date_req2"], "%d/%m/%Y").date()
+            currency_id = request.query["VAL_NM_RQ"]
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest()
+        return web.Response(body=_dynamic_xml(currency_id, start, end, currencies), content_type="application/xml")
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(middlewares=[faults])
+    app["stats"] = stats
+    app.router.add_get("/daily_json.js", daily)
+    app.router.add_get("/archive/{year}/{month}/{day}/daily_json.js", archive)
+    app.router.add_get("/scripts/XML_valFull.asp", valfull)
+    app.router.add_get("/scripts/XML_dynamic.asp", dynamic)
+    app.router.add_get("/_stats", get_stats)
+    return app
+
+
+def urls(base: str) -> Dict[str, str]:
+    """URL-адреса фейкового сервера в терминах config.py / CBRProvider"""
+    base = base.rstrip("/")
+    return {
+        "current_url": f"{base}/daily_json.js",
+        "archive_url": base + "/archive/{year}/{month:02d}/{day:02d}/daily_json.js",
+        "valfull_url": f"{base}/scripts/XML_valFull.asp",
+        "dynamic_url": f"{base}/scripts/XML_dynamic.asp",
+    }
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 0, **options) -> web.AppRunner:
+    """Запуск сервера в текущем event loop; port=0 - свободный порт (см. runner.addresses)"""
+    runner = web.AppRunner(create_app(**options))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый сервер API ЦБ РФ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа, секунды")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайная добавка к задержке, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 503")
+    parser.add_argument("--currencies", type=int, default=len(KNOWN_CODES), help="Число валют в ответах")
+    parser.add_argument("--recorded-dir", help="Каталог с записанными ответами (пути как у ЦБ)")
+    parser.add_argument("--publish-interval", type=float, default=0.0,
+                        help="Сдвигать дату курсов каждые N секунд (0 - не сдвигать)")
+    args = parser.parse_args()
+
+    base = f"http://{args.host}:{args.port}"
+    env = {"current_url": "CBR_URL", "archive_url": "CBR_ARCHIVE_URL",
+           "valfull_url": "CBR_VALFULL_URL", "dynamic_url": "CBR_DYNAMIC_URL"}
+    for key, url in urls(base).items():
+        print(f"export {env[key]}='{url}'")
+
+    app = create_app(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                     currencies=args.currencies, recorded_dir=args.recorded_dir,
+                     publish_interval=args.publish_interval)
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import io
+import math
+from datetime import date
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from config import CHART_FONT
+
+# Размер как у matplotlib: figsize=(10, 5) при 150 dpi
+WIDTH, HEIGHT = 1500, 750
+# Рисуем в увеличенном масштабе и уменьшаем: сглаживание линий и маркеров
+SUPERSAMPLE = 2
+
+LINE_COLOR = (31, 119, 180)
+GRID_COLOR = (190, 190, 190)
+AXIS_COLOR = (0, 0, 0)
+BACKGROUND = (255, 255, 255)
+
+TITLE_SIZE = 25
+LABEL_SIZE = 21
+TICK_SIZE = 19
+LINE_WIDTH = 4
+MARKER_RADIUS = 4
+TICK_LENGTH = 7
+PADDING = 16
+
+
+@lru_cache(maxsize=16)
+def _font(size: int) -> ImageFont.ImageFont:
+    """Шрифт с кириллицей: CHART_FONT, затем системные, затем встроенный в Pillow"""
+    for name in (CHART_FONT, "DejaVuSans.ttf", "arial.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def _text_size(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.ImageFont) -> Tuple[int, int]:
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top
+
+
+def _value_ticks(lo: float, hi: float, target: int = 6) -> Tuple[List[float], int]:
+    """Круглые деления оси значений в [lo, hi] и число знаков после запятой"""
+    raw = (hi - lo) / target
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    decimals = max(0, -math.floor(math.log10(step)))
+    if abs(round(step * 10 ** decimals) - step * 10 ** decimals) > 1e-9:
+        decimals += 1
+    ticks = []
+    value = math.ceil(lo / step) * step
+    while value <= hi + step * 1e-9:
+        ticks.append(value)
+        value += step
+    return ticks, decimals
+
+
+def _date_ticks(first: int, last: int, max_ticks: int = 10) -> List[int]:
+    """Деления оси дат (порядковые номера дней) с шагом не чаще max_ticks на график"""
+    span = max(last - first, 1)
+    step = next((s for s in (1, 2, 3, 7, 14, 30, 61, 91, 182) if span / s <= max_ticks), 365)
+    return list(range(first, last + 1, step))
+
+
+def _dashed_line(draw: ImageDraw.ImageDraw, start: Tuple[float, float], end: Tuple[float, float],
+                 dash: float, gap: float, fill, width: int):
+    """Пунктир по горизонтали или вертикали"""
+    (x0, y0), (x1, y1) = start, end
+    length = math.hypot(x1 - x0, y1 - y0)
+    if length == 0:
+        return
+    dx, dy = (x1 - x0) / length, (y1 - y0) / length
+    pos = 0.0
+    while pos < length:
+        seg_end = min(pos + dash, length)
+        draw.line([(x0 + dx * pos, y0 + dy * pos), (x0 + dx * seg_end, y0 + dy * seg_end)], fill=fill, width=width)
+        pos = seg_end + gap
+
+
+def _rotated_text(text: str, font: ImageFont.ImageFont, angle: float) -> Image.Image:
+    """Маска текста, повернутого против часовой стрелки"""
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (right - left + 2, bottom - top + 2), 0)
+    ImageDraw.Draw(mask).text((-left + 1, -top + 1), text, font=font, fill=255)
+    return mask.rotate(angle, resample=Image.BICUBIC, expand=True)
+
+
+def render_line_chart(dates: Sequence[date], values: Sequence[float], title: str,
+                      xlabel: str = "", ylabel: str = "") -> bytes:
+    """PNG линейного графика с маркерами, заголовком, подписями осей, сеткой и наклонными датами"""
+    s = SUPERSAMPLE
+    image = Image.new("RGB", (WIDTH * s, HEIGHT * s), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    title_font, label_font, tick_font = _font(TITLE_SIZE * s), _font(LABEL_SIZE * s), _font(TICK_SIZE * s)
+
+    # Пределы осей с полями 5%, как у matplotlib
+    xs = [d.toordinal() for d in dates]
+    x_lo, x_hi = min(xs), max(xs)
+    x_pad = max((x_hi - x_lo) * 0.05, 1)
+    y_lo, y_hi = min(values), max(values)
+    y_pad = (y_hi - y_lo) * 0.05 or max(abs(y_hi) * 0.01, 0.5)
+    x_min, x_max, y_min, y_max = x_lo - x_pad, x_hi + x_pad, y_lo - y_pad, y_hi + y_pad
+
+    y_ticks, decimals = _value_ticks(y_min, y_max)
+    y_labels = [f"{v:.{decimals}f}" for v in y_ticks]
+    x_ticks = _date_ticks(x_lo, x_hi)
+    date_format = "%d.%m" if x_hi - x_lo <= 60 else "%d.%m.%y"
+    x_labels = [_rotated_text(date.fromordinal(x).strftime(date_format), tick_font, 45) for x in x_ticks]
+
+    # Поля вокруг области графика под заголовок, подписи и деления
+    title_lines = title.split("\n")
+    title_height = sum(_text_size(draw, line, title_font)[1] + 8 * s for line in title_lines)
+    y_label_width = max(_text_size(draw, label, tick_font)[0] for label in y_labels)
+    x_label_height = max(mask.height for mask in x_labels)
+    left = PADDING * s + (LABEL_SIZE + 12) * s + y_label_width + TICK_LENGTH * s + 6 * s
+    right = WIDTH * s - PADDING * 2 * s
+    top = PADDING * s + title_height + 10 * s
+    bottom = HEIGHT * s - PADDING * s - (LABEL_SIZE + 10) * s - x_label_height - TICK_LENGTH * s
+
+    def to_px(x: float, y: float) -> Tuple[float, float]:
+        return (left + (x - x_min) / (x_max - x_min) * (right - left),
+                bottom - (y - y_min) / (y_max - y_min) * (bottom - top))
+
+    # Заголовок по центру области графика
+    y = PADDING * s
+    for line in title_lines:
+        w, h = _text_size(draw, line, title_font)
+        draw.text(((left + right - w) / 2, y), line, font=title_font, fill=AXIS_COLOR)
+        y += h + 8 * s
+
+    # Сетка и деления оси значений
+    for value, label in zip(y_ticks, y_labels):
+        _, py = to_px(x_min, value)
+        _dashed_line(draw, (left, py), (right, py), 8 * s, 5 * s, GRID_COLOR, s)
+        draw.line([(left - TICK_LENGTH * s, py), (left, py)], fill=AXIS_COLOR, width=s)
+        w, h = _text_size(draw, label, tick_font)
+        draw.text((left - TICK_LENGTH * s - 6 * s - w, py - h / 2), label, font=tick_font, fill=AXIS_COLOR)
+
+    # Сетка и наклонные подписи оси дат (правый верхний угол подписи - под делением)
+    for x, mask in zip(x_ticks, x_labels):
+        px, _ = to_px(x, y_min)
+        _dashed_line(draw, (px, top), (px, bottom), 8 * s, 5 * s, GRID_COLOR, s)
+        draw.line([(px, bottom), (px, bottom + TICK_LENGTH * s)], fill=AXIS_COLOR, width=s)
+        image.paste(AXIS_COLOR, (int(px - mask.width), int(bottom + TICK_LENGTH * s + 2 * s)), mask)
+
+    draw.rectangle([left, top, right, bottom], outline=AXIS_COLOR, width=s)
+
+    # Линия и маркеры
+    points = [to_px(x, v) for x, v in zip(xs, values)]
+    if len(points) > 1:
+        draw.line(points, fill=LINE_COLOR, width=LINE_WIDTH * s, joint="curve")
+    r = MARKER_RADIUS * s
+    for px, py in points:
+        draw.ellipse([px - r, py - r, px + r, py + r], fill=LINE_COLOR)
+
+    # Подписи осей
+    if xlabel:
+        w, h = _text_size(draw, xlabel, label_font)
+        draw.text(((left + right - w) / 2, HEIGHT * s - PADDING * s - h - 4 * s), xlabel,
+                  font=label_font, fill=AXIS_COLOR)
+    if ylabel:
+        mask = _rotated_text(ylabel, label_font, 90)
+        image.paste(AXIS_COLOR, (PADDING * s, int((top + bottom - mask.height) / 2)), mask)
+
+    buf = io.BytesIO()
+    image.reduce(s).save(buf, format="PNG")
+    return buf.getvalue()
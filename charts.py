@@ -0,0 +1,334 @@
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from config import (
+    CHART_WORKERS, CHART_QUEUE_SIZE, CHART_RENDER_TIMEOUT, CHART_RENDERER,
+    CHART_CACHE_MEMORY_BYTES, CHART_CACHE_DIR, CHART_CACHE_DISK_TTL, CHART_FILE_ID_CACHE_SIZE,
+)
+from metrics import CHART_CACHE_EVENTS, CHART_QUEUE, CHART_RENDER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ChartSpec(NamedTuple):
+    """Данные графика для процесса отрисовки (передаются через pickle)"""
+    dates: Tuple[date, ...]
+    values: Tuple[float, ...]
+    title: str
+    xlabel: str = "Дата"
+    ylabel: str = "RUB"
+
+
+# (валюта, период в днях, конец периода, дата последнего значения ряда)
+ChartKey = Tuple[str, int, str, str]
+
+
+class ChartBusyError(RuntimeError):
+    """Очередь отрисовки заполнена"""
+
+
+class ChartTimeoutError(RuntimeError):
+    """График не построен за отведенное время"""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+# Графики, которые рисуются или ждут свободный процесс
+_pending = 0
+
+
+_renderer: Optional[Callable[[ChartSpec], bytes]] = None
+
+
+def _render_pil(spec: ChartSpec) -> bytes:
+    """Отрисовка встроенным рендерером на Pillow (chart_pil.py)"""
+    from chart_pil import render_line_chart
+    return render_line_chart(spec.dates, spec.values, spec.title, spec.xlabel, spec.ylabel)
+
+
+def _render_matplotlib(spec: ChartSpec) -> bytes:
+    """Отрисовка через matplotlib"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 5))
+    try:
+        ax.plot(spec.dates, spec.values, marker="o", linewidth=2, markersize=4)
+        ax.set_title(spec.title, fontsize=12)
+        ax.set_xlabel(spec.xlabel)
+        ax.set_ylabel(spec.ylabel)
+        ax.grid(True, linestyle="--", alpha=0.6)
+        ax.tick_params(axis='x', rotation=45)
+        fig.tight_layout(pad=1.0)
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=150, bbox_inches='tight')
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def get_renderer(name: str = CHART_RENDERER) -> Callable[[ChartSpec], bytes]:
+    """Функция отрисовки по имени; без Pillow используется matplotlib"""
+    if name == "matplotlib":
+        return _render_matplotlib
+    if name != "pil":
+        logger.warning(f"Unknown CHART_RENDERER {name!r}, using pil")
+    try:
+        import chart_pil  # noqa: F401
+    except ImportError:
+        logger.warning("Pillow is not installed, falling back to matplotlib charts")
+        return _render_matplotlib
+    return _render_pil
+
+
+def _init_worker():
+    """Выбор и загрузка отрисовщика при старте процесса, а не на первом графике"""
+    global _renderer
+    _renderer = get_renderer()
+    if _renderer is _render_matplotlib:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot  # noqa: F401
+
+
+def render_png(spec: ChartSpec) -> bytes:
+    """Отрисовка линейного графика в PNG (выполняется в процессе пула)"""
+    global _renderer
+    if _renderer is None:
+        _renderer = get_renderer()
+    return _renderer(spec)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: дочерний процесс не наследует event loop, соединения БД и сессии
+        _pool = ProcessPoolExecutor(
+            max_workers=CHART_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        logger.info(f"Chart pool started with {CHART_WORKERS} worker processes")
+    return _pool
+
+
+def _recycle_pool(pool: ProcessPoolExecutor):
+    """Остановка пула с завислым процессом; следующий график запустит новый"""
+    global _pool
+    if _pool is not pool:
+        return
+    _pool = None
+    # ProcessPoolExecutor не умеет прерывать отдельную задачу - завершаем процессы пула
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def render_chart(spec: ChartSpec, timeout: float = CHART_RENDER_TIMEOUT) -> bytes:
+    """PNG графика из пула процессов, не блокируя event loop
+
+    Одновременно рисуется CHART_WORKERS графиков, еще CHART_QUEUE_SIZE ждут
+    в очереди; сверх этого сразу выбрасывается ChartBusyError. Если график
+    не готов за timeout, выбрасывается ChartTimeoutError.
+    """
+    global _pending
+    if _pending >= CHART_WORKERS + CHART_QUEUE_SIZE:
+        CHART_RENDER_SECONDS.labels("rejected").observe(0)
+        raise ChartBusyError("Слишком много графиков в очереди")
+
+    _pending += 1
+    CHART_QUEUE.set(_pending)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        pool = _get_pool()
+        loop = asyncio.get_running_loop()
+        png = await asyncio.wait_for(loop.run_in_executor(pool, render_png, spec), timeout)
+        outcome = "ok"
+        return png
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        logger.warning(f"Chart render timed out after {timeout}s, restarting chart pool")
+        _recycle_pool(pool)
+        raise ChartTimeoutError(f"График не построен за {timeout} с")
+    except BrokenProcessPool:
+        logger.error("Chart worker process died, restarting chart pool", exc_info=True)
+        _recycle_pool(pool)
+        raise
+    finally:
+        _pending -= 1
+        CHART_QUEUE.set(_pending)
+        CHART_RENDER_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+
+def shutdown_chart_pool():
+    """Остановка процессов отрисовки"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def chart_key(currency: str, days: int, end_date: date, last_data_date: date) -> ChartKey:
+    """Ключ готового графика: тот же период с теми же данными дает тот же PNG"""
+    return currency, days, end_date.isoformat(), last_data_date.isoformat()
+
+
+class ChartCache:
+    """Кеш готовых PNG: LRU в памяти с лимитом по байтам и каталог на диске
+
+    Диск переживает рестарт и общий для процессов бота; файлы старше
+    disk_ttl удаляются при записи не чаще раза в час.
+    """
+
+    def __init__(self, max_bytes: int = CHART_CACHE_MEMORY_BYTES, directory: Optional[str] = CHART_CACHE_DIR,
+                 disk_ttl: int = CHART_CACHE_DISK_TTL):
+        self.max_bytes = max_bytes
+        self.directory = directory or None
+        self.disk_ttl = disk_ttl
+        self._memory: "OrderedDict[ChartKey, bytes]" = OrderedDict()
+        self._size = 0
+        self._last_prune = 0.0
+
+    def _path(self, key: ChartKey) -> Optional[str]:
+        if self.directory is None:
+            return None
+        # Имя из хеша: валюта приходит из callback data и в путь не подставляется;
+        # смена CHART_RENDERER не отдает картинки прежнего отрисовщика
+        name = hashlib.sha256(repr((CHART_RENDERER, key)).encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f"{name}.png")
+
+    def get_memory(self, key: ChartKey) -> Optional[bytes]:
+        png = self._memory.get(key)
+        if png is not None:
+            self._memory.move_to_end(key)
+        return png
+
+    def put_memory(self, key: ChartKey, png: bytes):
+        if len(png) > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._memory[key] = png
+        self._size += len(png)
+        while self._size > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _read_disk(self, key: ChartKey) -> Optional[bytes]:
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key: ChartKey, png: bytes):
+        path = self._path(key)
+        if path is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+
+        if time.monotonic() - self._last_prune > 3600:
+            self._last_prune = time.monotonic()
+            cutoff = time.time() - self.disk_ttl
+            for entry in os.scandir(self.directory):
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    async def get(self, key: ChartKey) -> Tuple[Optional[bytes], str]:
+        """PNG и уровень, на котором он найден ("memory", "disk" или "miss")"""
+        png = self.get_memory(key)
+        if png is not None:
+            return png, "memory"
+        try:
+            png = await asyncio.to_thread(self._read_disk, key)
+        except OSError as e:
+            logger.warning(f"Error reading chart cache: {e}")
+            png = None
+        if png is not None:
+            self.put_memory(key, png)
+            return png, "disk"
+        return None, "miss"
+
+    async def put(self, key: ChartKey, png: bytes):
+        self.put_memory(key, png)
+        try:
+            await asyncio.to_thread(self._write_disk, key, png)
+        except OSError as e:
+            logger.warning(f"Error writing chart cache: {e}")
+
+
+_cache = ChartCache()
+# Ключ -> file_id фото, уже загруженного в Telegram
+_file_ids: "OrderedDict[ChartKey, str]" = OrderedDict()
+# Графики, которые сейчас рисуются: одинаковые запросы ждут одну отрисовку
+_inflight: Dict[ChartKey, asyncio.Future] = {}
+
+
+def get_chart_file_id(key: ChartKey) -> Optional[str]:
+    """file_id ранее отправленного графика: повторная отправка без отрисовки и загрузки"""
+    file_id = _file_ids.get(key)
+    if file_id is not None:
+        _file_ids.move_to_end(key)
+        CHART_CACHE_EVENTS.labels("file_id").inc()
+    return file_id
+
+
+def remember_chart_file_id(key: ChartKey, file_id: str):
+    """Запоминание file_id после первой загрузки графика"""
+    _file_ids[key] = file_id
+    _file_ids.move_to_end(key)
+    while len(_file_ids) > CHART_FILE_ID_CACHE_SIZE:
+        _file_ids.popitem(last=False)
+
+
+def forget_chart_file_id(key: ChartKey):
+    """Удаление file_id, который Telegram больше не принимает"""
+    _file_ids.pop(key, None)
+
+
+async def get_chart(key: ChartKey, spec: ChartSpec) -> bytes:
+    """PNG графика из кеша (память, диск) или из пула отрисовки"""
+    png, tier = await _cache.get(key)
+    if png is not None:
+        CHART_CACHE_EVENTS.labels(tier).inc()
+        return png
+
+    fut = _inflight.get(key)
+    if fut is None:
+        CHART_CACHE_EVENTS.labels("render").inc()
+
+        async def render_and_store() -> bytes:
+            rendered = await render_chart(spec)
+            await _cache.put(key, rendered)
+            return rendered
+
+        fut = asyncio.ensure_future(render_and_store())
+        _inflight[key] = fut
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        CHART_CACHE_EVENTS.labels("coalesced").inc()
+    # shield: отмена одного ожидающего не должна прерывать общую отрисовку
+    return await asyncio.shield(fut)
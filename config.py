@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения
@@ -6,6 +7,11 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_PATH = os.getenv("DB_PATH", "rates.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # Число долгоживущих соединений с SQLite
+DB_CACHE_SIZE_KIB = 16384  # Кеш страниц SQLite на соединение, КиБ
+DB_BUSY_TIMEOUT_MS = 5000  # Ожидание блокировки записи, мс
+DB_STATEMENT_CACHE_SIZE = 256  # Кеш подготовленных выражений на соединение
+LAST_SENT_FLUSH_ROWS = 500  # Отложенные записи last_sent_date сбрасываются пачками не больше N строк
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не установлен в .env")
@@ -16,11 +22,86 @@ DEFAULT_CURRENCIES = "USD,EUR"
 DEFAULT_WORKDAYS = [1, 2, 3, 4, 5]  # Понедельник-Пятница
 DEFAULT_NOTIFY_TIME = "08:00"
 
-# API URLs
-CBR_URL = "https://www.cbr-xml-daily.ru/daily_json.js"
-CBR_ARCHIVE_URL = "https://www.cbr-xml-daily.ru/archive/{year}/{month:02d}/{day:02d}/daily_json.js"
-CBR_VALFULL_URL = "https://www.cbr.ru/scripts/XML_valFull.asp"
-CBR_DYNAMIC_URL = "https://www.cbr.ru/scripts/XML_dynamic.asp"
+# API URLs (переопределяются через окружение, например для benchmarks/fake_cbr.py)
+CBR_URL = os.getenv("CBR_URL", "https://www.cbr-xml-daily.ru/daily_json.js")
+CBR_ARCHIVE_URL = os.getenv(
+    "CBR_ARCHIVE_URL", "https://www.cbr-xml-daily.ru/archive/{year}/{month:02d}/{day:02d}/daily_json.js"
+)
+CBR_VALFULL_URL = os.getenv("CBR_VALFULL_URL", "https://www.cbr.ru/scripts/XML_valFull.asp")
+CBR_DYNAMIC_URL = os.getenv("CBR_DYNAMIC_URL", "https://www.cbr.ru/scripts/XML_dynamic.asp")
+
+# Устойчивость запросов к API: повторы с джиттером и автомат защиты
+UPSTREAM_TIMEOUT = 10  # Таймаут одной попытки запроса JSON, секунды
+UPSTREAM_XML_TIMEOUT = 20  # Таймаут одной попытки запроса XML, секунды
+UPSTREAM_RETRIES = 2  # Число повторов после неудачной попытки
+UPSTREAM_BACKOFF_BASE = 0.5  # Базовая задержка между повторами, секунды
+UPSTREAM_BACKOFF_MAX = 5  # Максимальная задержка между повторами, секунды
+BREAKER_FAILURE_THRESHOLD = 5  # Сбоев подряд до размыкания автомата защиты
+BREAKER_RESET_TIMEOUT = 30  # Время до пробного запроса после размыкания, секунды
+
+# Кеширование текущих курсов
+CBR_TIMEZONE = 3  # Курсы ЦБ РФ публикуются по московскому времени
+CBR_PUBLICATION_WINDOW = (11, 16)  # Часы (МСК), в которые обычно выходят новые курсы
+RATES_CACHE_TTL = 3600  # TTL снимка курсов вне окна публикации, секунды
+RATES_CACHE_TTL_PUBLICATION = 300  # TTL снимка курсов в окне публикации, секунды
+RATES_STALE_WAIT = 2  # Сколько ждать обновления при устаревшем снимке, прежде чем отдать его, секунды
+RATES_POLL_INTERVAL = 600  # Фоновый условный опрос курсов вне окна публикации, секунды
+RATES_POLL_INTERVAL_PUBLICATION = 60  # Фоновый условный опрос курсов в окне публикации, секунды
+
+# Прогрев снимка курсов перед пиками рассылки
+PREFETCH_LEAD_SECONDS = 90  # За сколько секунд до минуты рассылки обновлять снимок
+PREFETCH_INTERVAL = 15  # Период проверки расписания, секунды
+PREFETCH_AFTER_PUBLICATION_DELAY = 120  # Обновление снимка после окна публикации ЦБ, секунды
+
+# Справочник валют ЦБ РФ (код -> внутренний ID)
+CURRENCY_DIRECTORY_REFRESH_INTERVAL = 86400  # Фоновое обновление справочника, секунды
+CURRENCY_DIRECTORY_MISS_REFRESH_INTERVAL = 3600  # Не чаще одного внепланового обновления при промахе
+
+# Локальное хранилище исторических курсов
+HISTORY_RECHECK_INTERVAL = 3600  # Как часто перепроверять последние дни ряда, секунды
+# История до начала периода графика для MA7/MA30 (30 дней и запас на праздники без курсов), дни
+STATS_MA_HISTORY_DAYS = 45
+
+# Отрисовка графиков статистики в отдельных процессах
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))  # Процессов отрисовки
+CHART_QUEUE_SIZE = 8  # Графиков в очереди сверх занятых процессов; остальным - отказ
+CHART_RENDER_TIMEOUT = 30  # Ожидание одного графика, секунды
+# Отрисовщик графиков: pil - встроенный на Pillow, matplotlib - прежний (если установлен)
+CHART_RENDERER = os.getenv("CHART_RENDERER", "pil")
+CHART_FONT = os.getenv("CHART_FONT", "DejaVuSans.ttf")  # TrueType-шрифт с кириллицей для pil
+CHART_CACHE_MEMORY_BYTES = 32 * 1024 * 1024  # Лимит готовых PNG в памяти, байт
+CHART_CACHE_DIR = os.getenv("CHART_CACHE_DIR", "chart_cache")  # Каталог готовых PNG; пусто - без диска
+CHART_CACHE_DISK_TTL = 3 * 86400  # Хранение PNG на диске, секунды
+CHART_FILE_ID_CACHE_SIZE = 4096  # Запомненных file_id загруженных в Telegram графиков
+
+# Режим процесса: all - бот и планировщик, bot - только бот (polling),
+# scheduler - только планировщик и доставка (можно запускать несколько процессов)
+BOT_MODE = os.getenv("BOT_MODE", "all")
+SCHEDULER_SHARDS = int(os.getenv("SCHEDULER_SHARDS", "1"))  # Число шардов user_id % N
+SCHEDULER_WORKER_ID = os.getenv("SCHEDULER_WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
+SCHEDULER_LEASE_TTL = 30  # Срок аренды шарда без продления, секунды
+SCHEDULER_HEARTBEAT_INTERVAL = 10  # Продление аренд и перераспределение шардов, секунды
+
+# HTTP-эндпоинт метрик в формате Prometheus (GET /metrics); 0 - отключен
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Рассылка уведомлений и лимиты Telegram Bot API
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "50"))  # Одновременных отправок при рассылке
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", "30"))  # Сообщений в секунду на бота
+TELEGRAM_RATE_BURST = 30  # Допустимый всплеск сверх средней скорости, сообщений
+TELEGRAM_CHAT_INTERVAL = 1.0  # Минимальный интервал между сообщениями рассылки в один чат, секунды
+TELEGRAM_RETRY_AFTER_ATTEMPTS = 3  # Повторов запроса после ответа 429 (RetryAfter)
+
+# Очередь исходящих сообщений (outbox) в SQLite
+OUTBOX_BATCH_SIZE = 100  # Сообщений, забираемых из очереди за раз
+OUTBOX_SEND_LEASE = 300  # На сколько секунд забранные сообщения скрываются от других воркеров
+OUTBOX_POLL_INTERVAL = 5  # Проверка отложенных повторов, секунды
+OUTBOX_MAX_ATTEMPTS = 5  # Попыток доставки до пометки failed
+OUTBOX_RETRY_BASE = 30  # Задержка перед первым повтором, секунды (далее удваивается)
+OUTBOX_RETRY_MAX = 3600  # Максимальная задержка между повторами, секунды
+OUTBOX_ALERT_TTL = 86400  # Сколько оповещение о пороге остается актуальным, секунды
+OUTBOX_RETENTION = 7 * 86400  # Хранение обработанных сообщений (и ключей идемпотентности), секунды
 
 # Определение словаря символов валют
 CURRENCY_SYMBOLS = {
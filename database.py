@@ -1,49 +1,276 @@
 import aiosqlite
+import asyncio
+import json
 import logging
-from typing import Optional, List, Tuple
-from config import DB_PATH
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Callable, Dict, Optional, List, Tuple
+from config import (
+    DB_PATH, DB_POOL_SIZE, DB_CACHE_SIZE_KIB, DB_BUSY_TIMEOUT_MS, DB_STATEMENT_CACHE_SIZE,
+    LAST_SENT_FLUSH_ROWS,
+)
+from utils import next_fire_timestamp
 
 logger = logging.getLogger(__name__)
 
+# Пул долгоживущих соединений: создается в init_db, закрывается в close_db
+_pool: Optional[asyncio.Queue] = None
+_connections: List[aiosqlite.Connection] = []
+
+# Буфер отложенной записи (user_id -> (last_sent_date, next_fire_utc)) и блокировка его сброса
+_pending_last_sent: Dict[int, Tuple[str, Optional[int]]] = {}
+_flush_lock = asyncio.Lock()
+
+# Подписчики на изменения данных: событие -> синхронные callback
+_listeners: Dict[str, List[Callable]] = {}
+
+# Версия схемы (PRAGMA user_version): увеличивается при каждом изменении _create_schema
+SCHEMA_VERSION = 1
+
 # Whitelist для защиты от SQL-инъекций
 ALLOWED_SETTINGS_FIELDS = {'currencies', 'notify_time', 'days', 'timezone', 'last_sent_date'}
 
+# Поля, от которых зависит время следующего уведомления (next_fire_utc)
+SCHEDULE_FIELDS = {'notify_time', 'days', 'timezone'}
+
+
+def add_listener(event: str, callback: Callable):
+    """Подписка на изменение данных (например, "schedule_changed": callback(user_id, next_fire_utc))"""
+    _listeners.setdefault(event, []).append(callback)
+
+
+def _notify(event: str, *args):
+    """Уведомление подписчиков после успешной записи"""
+    for callback in _listeners.get(event, []):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"Listener for {event} failed: {e}", exc_info=True)
+
+
+def _schedule_from() -> datetime:
+    """Точка отсчета для next_fire_utc: текущая минута тоже считается предстоящей"""
+    return datetime.utcnow().replace(second=0, microsecond=0) - timedelta(seconds=1)
+
+
+async def _open_connection() -> aiosqlite.Connection:
+    """Открытие соединения с настройками для конкурентной работы (WAL)"""
+    # cached_statements: подготовленные выражения переиспользуются, пока соединение живо
+    db = await aiosqlite.connect(DB_PATH, cached_statements=DB_STATEMENT_CACHE_SIZE)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KIB}")
+    await db.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    return db
+
+
+@asynccontextmanager
+async def _connection() -> AsyncIterator[aiosqlite.Connection]:
+    """Получение соединения из пула (до init_db - временного соединения)"""
+    if _pool is None:
+        db = await _open_connection()
+        try:
+            yield db
+        finally:
+            await db.close()
+        return
+
+    db = await _pool.get()
+    try:
+        yield db
+    finally:
+        # Незавершенная транзакция (после ошибки) не должна достаться следующему вызову
+        if db.in_transaction:
+            await db.rollback()
+        _pool.put_nowait(db)
+
+
+async def close_db():
+    """Сброс отложенных записей и закрытие пула соединений с БД"""
+    global _pool
+    try:
+        await flush_last_sent_dates()
+    except Exception:
+        logger.error(f"Lost {len(_pending_last_sent)} pending last_sent_date updates on shutdown")
+    _pool = None
+    for db in _connections:
+        await db.close()
+    _connections.clear()
+    logger.info("Database connections closed")
+
+
+async def _create_schema(db: aiosqlite.Connection):
+    """Создание таблиц и индексов, добавление новых столбцов в существующие таблицы"""
+    # Создание таблиц
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        currencies TEXT DEFAULT 'USD,EUR',
+        notify_time TEXT DEFAULT '08:00',
+        days TEXT DEFAULT '1,2,3,4,5',
+        timezone TEXT DEFAULT '3',
+        last_sent_date TEXT
+    );
+    """)
+
+    # Время следующего уведомления (UTC, секунды Unix): планировщик выбирает
+    # только наступившие строки по индексу, не разбирая настройки всех пользователей
+    cur = await db.execute("PRAGMA table_info(user_settings)")
+    columns = {row[1] for row in await cur.fetchall()}
+    if "next_fire_utc" not in columns:
+        await db.execute("ALTER TABLE user_settings ADD COLUMN next_fire_utc INTEGER")
+
+    # Чаты, заблокировавшие бота или удаленные: не планируются (next_fire_utc = NULL)
+    # и не получают оповещений, пока пользователь снова не отправит /start
+    if "active" not in columns:
+        await db.execute("ALTER TABLE user_settings ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+        await db.execute("ALTER TABLE user_settings ADD COLUMN deactivated_at TEXT")
+
+    await db.execute("""
+    CREATE INDEX IF NOT EXISTS idx_user_settings_next_fire ON user_settings(next_fire_utc);
+    """)
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS thresholds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        currency TEXT NOT NULL,
+        value REAL NOT NULL,
+        comment TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES user_settings(user_id) ON DELETE CASCADE
+    );
+    """)
+
+    # Создание индексов для оптимизации запросов
+    await db.execute("""
+    CREATE INDEX IF NOT EXISTS idx_thresholds_user_id ON thresholds(user_id);
+    """)
+
+    await db.execute("""
+    CREATE INDEX IF NOT EXISTS idx_thresholds_currency ON thresholds(currency);
+    """)
+
+    # Дата курсов, по которой уже отправлено оповещение: после рестарта не повторяется
+    cur = await db.execute("PRAGMA table_info(thresholds)")
+    columns = {row[1] for row in await cur.fetchall()}
+    if "last_alert_date" not in columns:
+        await db.execute("ALTER TABLE thresholds ADD COLUMN last_alert_date TEXT")
+
+    # Архив курсов ЦБ по датам: прошедшие даты не меняются, храним весь Valute
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS rates_archive (
+        date TEXT PRIMARY KEY,
+        payload TEXT NOT NULL,
+        fetched_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    # Справочник валют ЦБ: ISO-код -> внутренний ID для XML_dynamic
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS currency_directory (
+        code TEXT PRIMARY KEY,
+        cbr_id TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    # Исторические курсы (за 1 единицу валюты) и загруженный диапазон дат по каждой валюте
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS historical_rates (
+        currency TEXT NOT NULL,
+        date TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (currency, date)
+    ) WITHOUT ROWID;
+    """)
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS historical_coverage (
+        currency TEXT PRIMARY KEY,
+        start_date TEXT NOT NULL,
+        end_date TEXT NOT NULL,
+        checked_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    # Очередь исходящих сообщений: ключ идемпотентности не дает поставить
+    # одно уведомление дважды, next_attempt_at - время следующей попытки
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL,
+        expires_at INTEGER,
+        last_error TEXT,
+        created_at INTEGER NOT NULL,
+        sent_at INTEGER
+    );
+    """)
+
+    await db.execute("""
+    CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending';
+    """)
+
+    # Аренда шардов планировщика: процесс обрабатывает пользователей с user_id % N == shard
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS scheduler_leases (
+        shard INTEGER PRIMARY KEY,
+        owner TEXT,
+        expires_at INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS scheduler_workers (
+        worker_id TEXT PRIMARY KEY,
+        heartbeat_at INTEGER NOT NULL
+    );
+    """)
+
 
 async def init_db():
-    """Инициализация базы данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Создание таблиц
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS user_settings (
-            user_id INTEGER PRIMARY KEY,
-            currencies TEXT DEFAULT 'USD,EUR',
-            notify_time TEXT DEFAULT '08:00',
-            days TEXT DEFAULT '1,2,3,4,5',
-            timezone TEXT DEFAULT '3',
-            last_sent_date TEXT
-        );
-        """)
-
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS thresholds (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            currency TEXT NOT NULL,
-            value REAL NOT NULL,
-            comment TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(user_id) REFERENCES user_settings(user_id) ON DELETE CASCADE
-        );
-        """)
-
-        # Создание индексов для оптимизации запросов
-        await db.execute("""
-        CREATE INDEX IF NOT EXISTS idx_thresholds_user_id ON thresholds(user_id);
-        """)
-
-        await db.execute("""
-        CREATE INDEX IF NOT EXISTS idx_thresholds_currency ON thresholds(currency);
-        """)
+    """Инициализация базы данных и пула соединений"""
+    global _pool
+    if _pool is None:
+        pool = asyncio.Queue()
+        for _ in range(DB_POOL_SIZE):
+            db = await _open_connection()
+            _connections.append(db)
+            pool.put_nowait(db)
+        _pool = pool
+
+    async with _connection() as db:
+        # IMMEDIATE: проверка версии и DDL под блокировкой записи, иначе процессы,
+        # стартующие одновременно, оба выполнят ALTER TABLE
+        await db.execute("BEGIN IMMEDIATE")
+        # Схема уже текущей версии: DDL и проверки столбцов не выполняются
+        cur = await db.execute("PRAGMA user_version")
+        (version,) = await cur.fetchone()
+        if version < SCHEMA_VERSION:
+            await _create_schema(db)
+            await db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            logger.info(f"Database schema migrated from version {version} to {SCHEMA_VERSION}")
+
+        # Активные пользователи без срока уведомления (после добавления столбца next_fire_utc)
+        cur = await db.execute(
+            "SELECT user_id, notify_time, days, timezone FROM user_settings WHERE next_fire_utc IS NULL AND active=1"
+        )
+        now = _schedule_from()
+        backfill = [
+            (next_fire_timestamp(notify_time, days, tz, now), user_id)
+            for user_id, notify_time, days, tz in await cur.fetchall()
+        ]
+        backfill = [(fire, user_id) for fire, user_id in backfill if fire is not None]
+        if backfill:
+            await db.executemany("UPDATE user_settings SET next_fire_utc=? WHERE user_id=?", backfill)
+            logger.info(f"Computed next_fire_utc for {len(backfill)} users")
 
         await db.commit()
         logger.info("Database initialized successfully")
@@ -52,16 +279,23 @@ async def init_db():
 async def get_settings(user_id: int) -> Optional[Tuple]:
     """Получение настроек пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _connection() as db:
             cur = await db.execute(
                 "SELECT user_id, currencies, notify_time, days, timezone, last_sent_date FROM user_settings WHERE user_id=?",
                 (user_id,)
             )
             row = await cur.fetchone()
             if not row:
-                await db.execute("INSERT INTO user_settings (user_id) VALUES (?)", (user_id,))
+                await db.execute("INSERT OR IGNORE INTO user_settings (user_id) VALUES (?)", (user_id,))
+                cur = await db.execute(
+                    "SELECT user_id, currencies, notify_time, days, timezone, last_sent_date FROM user_settings WHERE user_id=?",
+                    (user_id,)
+                )
+                row = await cur.fetchone()
+                next_fire = next_fire_timestamp(row[2], row[3], row[4], _schedule_from())
+                await db.execute("UPDATE user_settings SET next_fire_utc=? WHERE user_id=?", (next_fire, user_id))
                 await db.commit()
-                return await get_settings(user_id)
+                _notify("schedule_changed", user_id, next_fire)
             return row
     except Exception as e:
         logger.error(f"Error getting settings for user {user_id}: {e}", exc_info=True)
@@ -80,10 +314,21 @@ async def update_settings(user_id: int, field: str, value: str):
         value = value[:500]  # Ограничение длины строки
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _connection() as db:
             # Безопасно: field проверен по белому списку
             await db.execute(f"UPDATE user_settings SET {field}=? WHERE user_id=?", (value, user_id))
+            next_fire = None
+            if field in SCHEDULE_FIELDS:
+                cur = await db.execute(
+                    "SELECT notify_time, days, timezone FROM user_settings WHERE user_id=? AND active=1", (user_id,)
+                )
+                row = await cur.fetchone()
+                if row:
+                    next_fire = next_fire_timestamp(*row, _schedule_from())
+                    await db.execute("UPDATE user_settings SET next_fire_utc=? WHERE user_id=?", (next_fire, user_id))
             await db.commit()
+            if next_fire is not None:
+                _notify("schedule_changed", user_id, next_fire)
             logger.info(f"Updated {field} for user {user_id}")
     except Exception as e:
         logger.error(f"Error updating settings for user {user_id}: {e}", exc_info=True)
@@ -93,7 +338,7 @@ async def update_settings(user_id: int, field: str, value: str):
 async def get_user_thresholds(user_id: int) -> List[Tuple]:
     """Получение пороговых значений пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _connection() as db:
             cur = await db.execute(
                 "SELECT id, currency, value, comment FROM thresholds WHERE user_id=?",
                 (user_id,)
@@ -104,8 +349,8 @@ async def get_user_thresholds(user_id: int) -> List[Tuple]:
         raise
 
 
-async def add_threshold(user_id: int, currency: str, value: float, comment: str):
-    """Добавление порогового значения"""
+async def add_threshold(user_id: int, currency: str, value: float, comment: str) -> int:
+    """Добавление порогового значения (возвращает его ID)"""
     # Валидация и санитизация входных данных
     currency = currency.strip().upper()[:10]  # Ограничение длины
     if comment:
@@ -115,13 +360,16 @@ async def add_threshold(user_id: int, currency: str, value: float, comment: str)
         raise ValueError("Threshold value must be positive")
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
+        async with _connection() as db:
+            cur = await db.execute(
                 "INSERT INTO thresholds (user_id, currency, value, comment) VALUES (?,?,?,?)",
                 (user_id, currency, value, comment)
             )
+            threshold_id = cur.lastrowid
             await db.commit()
             logger.info(f"Added threshold for user {user_id}: {currency} {value}")
+        _notify("threshold_added", threshold_id, user_id, currency, value, comment)
+        return threshold_id
     except Exception as e:
         logger.error(f"Error adding threshold for user {user_id}: {e}", exc_info=True)
         raise
@@ -130,7 +378,7 @@ async def add_threshold(user_id: int, currency: str, value: float, comment: str)
 async def delete_threshold(threshold_id: int, user_id: int) -> Optional[Tuple[str, float]]:
     """Удаление порогового значения"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _connection() as db:
             cur = await db.execute(
                 "SELECT currency, value FROM thresholds WHERE id=? AND user_id=?",
                 (threshold_id, user_id)
@@ -143,31 +391,500 @@ async def delete_threshold(threshold_id: int, user_id: int) -> Optional[Tuple[st
             await db.execute("DELETE FROM thresholds WHERE id=? AND user_id=?", (threshold_id, user_id))
             await db.commit()
             logger.info(f"Deleted threshold {threshold_id} for user {user_id}")
-            return (currency, value)
+        _notify("threshold_deleted", threshold_id)
+        return (currency, value)
     except Exception as e:
         logger.error(f"Error deleting threshold {threshold_id} for user {user_id}: {e}", exc_info=True)
         raise
 
 
-async def get_all_users_settings() -> List[Tuple]:
-    """Получение настроек всех пользователей для scheduler"""
+async def get_all_thresholds() -> List[Tuple]:
+    """Получение пороговых значений активных пользователей для индекса оповещений"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "SELECT t.id, t.user_id, t.currency, t.value, t.comment, t.last_alert_date "
+                "FROM thresholds t JOIN user_settings u ON u.user_id = t.user_id WHERE u.active=1"
+            )
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting all thresholds: {e}", exc_info=True)
+        raise
+
+
+async def mark_thresholds_alerted(threshold_ids: List[int], rates_date: str):
+    """Отметка об отправленных оповещениях по дате курсов"""
+    if not threshold_ids:
+        return
+    try:
+        async with _connection() as db:
+            await db.executemany(
+                "UPDATE thresholds SET last_alert_date=? WHERE id=?",
+                [(rates_date, tid) for tid in threshold_ids]
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error marking thresholds alerted: {e}", exc_info=True)
+        raise
+
+
+def _shard_filter(shards: Optional[Tuple[int, List[int]]]) -> Tuple[str, List[int]]:
+    """Условие выборки пользователей шардов: shards = (число шардов, номера своих шардов)"""
+    if shards is None:
+        return "", []
+    shard_count, owned = shards
+    placeholders = ",".join("?" * len(owned))
+    return f" AND user_id % ? IN ({placeholders})", [shard_count, *owned]
+
+
+async def get_due_users(now_ts: int, shards: Optional[Tuple[int, List[int]]] = None) -> List[Tuple]:
+    """Получение пользователей, время уведомления которых наступило (по индексу next_fire_utc)"""
+    shard_sql, shard_params = _shard_filter(shards)
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "SELECT user_id, currencies, notify_time, days, timezone, last_sent_date, next_fire_utc "
+                f"FROM user_settings WHERE next_fire_utc <= ?{shard_sql} ORDER BY next_fire_utc",
+                (now_ts, *shard_params)
+            )
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting due users: {e}", exc_info=True)
+        raise
+
+
+async def get_next_fire_time(shards: Optional[Tuple[int, List[int]]] = None) -> Optional[int]:
+    """Получение ближайшего времени уведомления среди пользователей (своих шардов)"""
+    shard_sql, shard_params = _shard_filter(shards)
+    try:
+        async with _connection() as db:
+            # Обход индекса next_fire_utc до первой подходящей строки
+            cur = await db.execute(
+                f"SELECT next_fire_utc FROM user_settings WHERE next_fire_utc IS NOT NULL{shard_sql} "
+                "ORDER BY next_fire_utc LIMIT 1",
+                shard_params
+            )
+            row = await cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Error getting next fire time: {e}", exc_info=True)
+        raise
+
+
+async def get_upcoming_fires(from_ts: int, to_ts: int) -> List[Tuple]:
+    """Получение предстоящих уведомлений: (next_fire_utc, валюты, число пользователей)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _connection() as db:
             cur = await db.execute(
-                "SELECT user_id, currencies, notify_time, days, timezone, last_sent_date FROM user_settings"
+                "SELECT next_fire_utc, currencies, COUNT(*) FROM user_settings "
+                "WHERE next_fire_utc BETWEEN ? AND ? GROUP BY next_fire_utc, currencies",
+                (from_ts, to_ts)
             )
             return await cur.fetchall()
     except Exception as e:
-        logger.error(f"Error getting all users settings: {e}", exc_info=True)
+        logger.error(f"Error getting upcoming fires: {e}", exc_info=True)
+        raise
+
+
+async def get_archived_rates(date_iso: str) -> Optional[Dict]:
+    """Получение сохраненных курсов (Valute) за дату"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute("SELECT payload FROM rates_archive WHERE date=?", (date_iso,))
+            row = await cur.fetchone()
+            return json.loads(row[0]) if row else None
+    except Exception as e:
+        logger.error(f"Error getting archived rates for {date_iso}: {e}", exc_info=True)
+        raise
+
+
+async def save_archived_rates(date_iso: str, valute: Dict):
+    """Сохранение курсов (Valute) за дату в архив"""
+    try:
+        async with _connection() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO rates_archive (date, payload) VALUES (?, ?)",
+                (date_iso, json.dumps(valute, ensure_ascii=False))
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error saving archived rates for {date_iso}: {e}", exc_info=True)
+        raise
+
+
+async def get_currency_directory() -> Tuple[Dict[str, str], Optional[str]]:
+    """Получение сохраненного справочника валют и времени его обновления (UTC)"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute("SELECT code, cbr_id, updated_at FROM currency_directory")
+            rows = await cur.fetchall()
+            updated_at = min((r[2] for r in rows), default=None)
+            return {code: cbr_id for code, cbr_id, _ in rows}, updated_at
+    except Exception as e:
+        logger.error(f"Error getting currency directory: {e}", exc_info=True)
         raise
 
 
-async def update_last_sent_date(user_id: int, date_iso: str):
-    """Обновление даты последней отправки"""
+async def save_currency_directory(directory: Dict[str, str]):
+    """Полная замена сохраненного справочника валют"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE user_settings SET last_sent_date=? WHERE user_id=?", (date_iso, user_id))
+        async with _connection() as db:
+            await db.execute("DELETE FROM currency_directory")
+            await db.executemany(
+                "INSERT INTO currency_directory (code, cbr_id) VALUES (?, ?)",
+                list(directory.items())
+            )
             await db.commit()
+            logger.info(f"Saved currency directory: {len(directory)} currencies")
+    except Exception as e:
+        logger.error(f"Error saving currency directory: {e}", exc_info=True)
+        raise
+
+
+async def get_historical_coverage(currency: str) -> Optional[Tuple[str, str, str]]:
+    """Получение загруженного диапазона дат (start, end, checked_at) по валюте"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "SELECT start_date, end_date, checked_at FROM historical_coverage WHERE currency=?",
+                (currency,)
+            )
+            return await cur.fetchone()
+    except Exception as e:
+        logger.error(f"Error getting historical coverage for {currency}: {e}", exc_info=True)
+        raise
+
+
+async def get_historical_rates(currency: str, start_iso: str, end_iso: str) -> List[Tuple[str, float]]:
+    """Получение сохраненных исторических курсов за период"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "SELECT date, value FROM historical_rates WHERE currency=? AND date BETWEEN ? AND ? ORDER BY date",
+                (currency, start_iso, end_iso)
+            )
+            return await cur.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting historical rates for {currency}: {e}", exc_info=True)
+        raise
+
+
+async def save_historical_rates(currency: str, start_iso: str, end_iso: str, records: List[Tuple[str, float]]):
+    """Сохранение исторических курсов и расширение загруженного диапазона
+
+    Диапазон [start_iso, end_iso] должен примыкать к уже загруженному или пересекаться с ним.
+    """
+    try:
+        async with _connection() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO historical_rates (currency, date, value) VALUES (?, ?, ?)",
+                [(currency, d, v) for d, v in records]
+            )
+            await db.execute("""
+            INSERT INTO historical_coverage (currency, start_date, end_date) VALUES (?, ?, ?)
+            ON CONFLICT(currency) DO UPDATE SET
+                start_date = MIN(start_date, excluded.start_date),
+                checked_at = CASE WHEN excluded.end_date >= end_date THEN excluded.checked_at ELSE checked_at END,
+                end_date = MAX(end_date, excluded.end_date)
+            """, (currency, start_iso, end_iso))
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error saving historical rates for {currency}: {e}", exc_info=True)
+        raise
+
+
+async def queue_last_sent_date(user_id: int, date_iso: Optional[str], next_fire_utc: Optional[int]):
+    """Отложенное обновление даты последней отправки и времени следующего уведомления"""
+    _pending_last_sent[user_id] = (date_iso, next_fire_utc)
+    if len(_pending_last_sent) >= LAST_SENT_FLUSH_ROWS:
+        await flush_last_sent_dates()
+
+
+async def flush_last_sent_dates() -> int:
+    """Запись накопленных дат отправки и следующих уведомлений одной транзакцией
+
+    Отключенным пользователям (deactivate_users) срок уведомления не возвращается.
+    """
+    async with _flush_lock:
+        if not _pending_last_sent:
+            return 0
+        batch = list(_pending_last_sent.items())
+        _pending_last_sent.clear()
+        try:
+            async with _connection() as db:
+                await db.executemany(
+                    "UPDATE user_settings SET last_sent_date=?, next_fire_utc=? WHERE user_id=? AND active=1",
+                    [(date_iso, next_fire, user_id) for user_id, (date_iso, next_fire) in batch]
+                )
+                await db.commit()
+            logger.info(f"Flushed last_sent_date for {len(batch)} users")
+            return len(batch)
+        except Exception as e:
+            # Возвращаем в буфер, не затирая более свежие значения
+            for user_id, pending in batch:
+                _pending_last_sent.setdefault(user_id, pending)
+            logger.error(f"Error flushing last sent dates: {e}", exc_info=True)
+            raise
+
+
+async def enqueue_outbox(messages: List[Tuple[str, int, str, str, Optional[int]]]) -> int:
+    """Постановка сообщений в очередь: (ключ идемпотентности, user_id, вид, текст, срок актуальности)
+
+    Сообщения с уже известным ключом и сообщения отключенным пользователям
+    пропускаются. Возвращает число добавленных.
+    """
+    if not messages:
+        return 0
+    now = int(time.time())
+    try:
+        async with _connection() as db:
+            before = db.total_changes
+            # Сообщения отключенным пользователям не ставятся (их мог отключить другой процесс)
+            await db.executemany(
+                "INSERT OR IGNORE INTO outbox (idempotency_key, user_id, kind, text, next_attempt_at, expires_at, created_at) "
+                "SELECT ?,?,?,?,?,?,? WHERE NOT EXISTS "
+                "(SELECT 1 FROM user_settings WHERE user_id=? AND active=0)",
+                [(key, user_id, kind, text, now, expires_at, now, user_id)
+                 for key, user_id, kind, text, expires_at in messages]
+            )
+            await db.commit()
+            added = db.total_changes - before
+    except Exception as e:
+        logger.error(f"Error enqueuing {len(messages)} outbox messages: {e}", exc_info=True)
+        raise
+    if added:
+        _notify("outbox_enqueued", added)
+    return added
+
+
+async def claim_outbox(now: int, limit: int, lease: int) -> List[Tuple]:
+    """Захват готовых к отправке сообщений: до истечения lease их не заберет другой воркер
+
+    Возвращает строки (id, user_id, kind, text, attempts, expires_at).
+    """
+    try:
+        async with _connection() as db:
+            # IMMEDIATE: выборка и захват атомарны и между процессами
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                "SELECT id, user_id, kind, text, attempts, expires_at FROM outbox "
+                "WHERE status='pending' AND next_attempt_at<=? ORDER BY next_attempt_at LIMIT ?",
+                (now, limit)
+            )
+            rows = await cur.fetchall()
+            if rows:
+                await db.executemany(
+                    "UPDATE outbox SET attempts=attempts+1, next_attempt_at=? WHERE id=?",
+                    [(now + lease, row[0]) for row in rows]
+                )
+            await db.commit()
+            return [(row[0], row[1], row[2], row[3], row[4] + 1, row[5]) for row in rows]
+    except Exception as e:
+        logger.error(f"Error claiming outbox messages: {e}", exc_info=True)
+        raise
+
+
+async def complete_outbox(sent: List[int], retry: List[Tuple[int, int, str]],
+                          failed: List[Tuple[int, str, str]], now: int):
+    """Запись результатов доставки: отправленные, отложенные (id, время повтора, ошибка) и
+    окончательно неудачные (id, статус, ошибка)"""
+    try:
+        async with _connection() as db:
+            if sent:
+                await db.executemany(
+                    "UPDATE outbox SET status='sent', sent_at=?, last_error=NULL WHERE id=?",
+                    [(now, mid) for mid in sent]
+                )
+            if retry:
+                await db.executemany(
+                    "UPDATE outbox SET next_attempt_at=?, last_error=? WHERE id=?",
+                    [(next_attempt, error, mid) for mid, next_attempt, error in retry]
+                )
+            if failed:
+                await db.executemany(
+                    "UPDATE outbox SET status=?, last_error=? WHERE id=?",
+                    [(status, error, mid) for mid, status, error in failed]
+                )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error completing outbox messages: {e}", exc_info=True)
+        raise
+
+
+async def get_outbox_counts() -> Dict[str, int]:
+    """Число сообщений в очереди по статусам и возраст самого старого ожидающего, секунды"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+            counts = {status: count for status, count in await cur.fetchall()}
+            cur = await db.execute("SELECT MIN(created_at) FROM outbox WHERE status='pending'")
+            oldest = (await cur.fetchone())[0]
+            counts["oldest_pending_age"] = int(time.time()) - oldest if oldest else 0
+            return counts
+    except Exception as e:
+        logger.error(f"Error getting outbox counts: {e}", exc_info=True)
+        raise
+
+
+async def prune_outbox(before: int) -> int:
+    """Удаление обработанных сообщений, созданных раньше before"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "DELETE FROM outbox WHERE status!='pending' AND created_at<?", (before,)
+            )
+            await db.commit()
+            return cur.rowcount
+    except Exception as e:
+        logger.error(f"Error pruning outbox: {e}", exc_info=True)
+        raise
+
+
+async def scheduler_heartbeat(worker_id: str, shard_count: int, now: int,
+                              ttl: int) -> Tuple[List[Tuple[int, Optional[str], int]], List[str]]:
+    """Отметка живого процесса планировщика: аренды шардов и список живых процессов
+
+    Недостающие шарды создаются свободными; процессы без отметки дольше ttl считаются умершими.
+    """
+    try:
+        async with _connection() as db:
+            await db.execute(
+                "INSERT INTO scheduler_workers (worker_id, heartbeat_at) VALUES (?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at=excluded.heartbeat_at",
+                (worker_id, now)
+            )
+            await db.execute("DELETE FROM scheduler_workers WHERE heartbeat_at < ?", (now - 10 * ttl,))
+            await db.executemany(
+                "INSERT OR IGNORE INTO scheduler_leases (shard) VALUES (?)",
+                [(shard,) for shard in range(shard_count)]
+            )
+            await db.commit()
+            cur = await db.execute(
+                "SELECT shard, owner, expires_at FROM scheduler_leases WHERE shard < ? ORDER BY shard",
+                (shard_count,)
+            )
+            leases = await cur.fetchall()
+            cur = await db.execute(
+                "SELECT worker_id FROM scheduler_workers WHERE heartbeat_at >= ? ORDER BY worker_id",
+                (now - ttl,)
+            )
+            workers = [row[0] for row in await cur.fetchall()]
+            return leases, workers
+    except Exception as e:
+        logger.error(f"Error recording scheduler heartbeat: {e}", exc_info=True)
+        raise
+
+
+async def remove_scheduler_worker(worker_id: str):
+    """Удаление отметки процесса планировщика при штатной остановке"""
+    try:
+        async with _connection() as db:
+            await db.execute("DELETE FROM scheduler_workers WHERE worker_id=?", (worker_id,))
+            await db.execute(
+                "UPDATE scheduler_leases SET owner=NULL, expires_at=0 WHERE owner=?", (worker_id,)
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error removing scheduler worker {worker_id}: {e}", exc_info=True)
+        raise
+
+
+async def acquire_shard_lease(shard: int, owner: str, now: int, ttl: int) -> bool:
+    """Захват или продление аренды шарда (compare-and-set: свободный, истекший или свой)"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "UPDATE scheduler_leases SET owner=?, expires_at=? "
+                "WHERE shard=? AND (owner=? OR owner IS NULL OR expires_at<?)",
+                (owner, now + ttl, shard, owner, now)
+            )
+            await db.commit()
+            return cur.rowcount == 1
+    except Exception as e:
+        logger.error(f"Error acquiring lease for shard {shard}: {e}", exc_info=True)
+        raise
+
+
+async def release_shard_lease(shard: int, owner: str):
+    """Освобождение своей аренды шарда"""
+    try:
+        async with _connection() as db:
+            await db.execute(
+                "UPDATE scheduler_leases SET owner=NULL, expires_at=0 WHERE shard=? AND owner=?",
+                (shard, owner)
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error releasing lease for shard {shard}: {e}", exc_info=True)
+        raise
+
+
+async def deactivate_users(user_ids: List[int]) -> int:
+    """Отключение пользователей, чаты которых недоступны (бот заблокирован, чат удален)
+
+    Расписание сбрасывается, ожидающие сообщения в outbox отменяются. Возвращает
+    число отключенных пользователей.
+    """
+    if not user_ids:
+        return 0
+    try:
+        async with _connection() as db:
+            before = db.total_changes
+            await db.executemany(
+                "UPDATE user_settings SET active=0, deactivated_at=CURRENT_TIMESTAMP, next_fire_utc=NULL "
+                "WHERE user_id=? AND active=1",
+                [(user_id,) for user_id in user_ids]
+            )
+            deactivated = db.total_changes - before
+            await db.executemany(
+                "UPDATE outbox SET status='failed', last_error='chat inactive' WHERE user_id=? AND status='pending'",
+                [(user_id,) for user_id in user_ids]
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error deactivating {len(user_ids)} users: {e}", exc_info=True)
+        raise
+    if deactivated:
+        logger.info(f"Deactivated {deactivated} unreachable chats")
+        _notify("users_deactivated", list(user_ids))
+    return deactivated
+
+
+async def reactivate_user(user_id: int) -> bool:
+    """Повторное включение отключенного пользователя (при /start)"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute(
+                "SELECT notify_time, days, timezone FROM user_settings WHERE user_id=? AND active=0", (user_id,)
+            )
+            row = await cur.fetchone()
+            if not row:
+                return False
+            next_fire = next_fire_timestamp(*row, _schedule_from())
+            await db.execute(
+                "UPDATE user_settings SET active=1, deactivated_at=NULL, next_fire_utc=? WHERE user_id=?",
+                (next_fire, user_id)
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error reactivating user {user_id}: {e}", exc_info=True)
+        raise
+    logger.info(f"Reactivated user {user_id}")
+    _notify("user_reactivated", user_id)
+    if next_fire is not None:
+        _notify("schedule_changed", user_id, next_fire)
+    return True
+
+
+async def get_user_counts() -> Dict[str, int]:
+    """Число активных и отключенных пользователей"""
+    try:
+        async with _connection() as db:
+            cur = await db.execute("SELECT active, COUNT(*) FROM user_settings GROUP BY active")
+            counts = {"active": 0, "inactive": 0}
+            for active, count in await cur.fetchall():
+                counts["active" if active else "inactive"] += count
+            return counts
     except Exception as e:
-        logger.error(f"Error updating last sent date for user {user_id}: {e}", exc_info=True)
+        logger.error(f"Error getting user counts: {e}", exc_info=True)
         raise
@@ -3,7 +3,7 @@ from aiogram import types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 
-from database import get_settings
+from database import get_settings, reactivate_user
 from api import fetch_rates, fetch_rates_by_date
 from utils import format_rates_for_user
 from keyboards import main_menu
@@ -13,6 +13,8 @@ from states import DateForm
 async def cmd_start(m: types.Message):
     """Обработка команды /start"""
     await get_settings(m.from_user.id)
+    # Пользователь, ранее заблокировавший бота, снова получает уведомления
+    await reactivate_user(m.from_user.id)
     await m.answer("Привет! Я бот курсов по данным ЦБ РФ. Выберите действие:", reply_markup=main_menu())
 
 
@@ -23,7 +25,7 @@ async def handle_send_now(m: types.Message):
     tz = int(row[4] or 0)
     res = await fetch_rates(currencies)
     user_now = datetime.utcnow() + timedelta(hours=tz)
-    text = format_rates_for_user(res.get("base", "RUB"), user_now, res.get("rates", {}))
+    text = format_rates_for_user(res.get("base", "RUB"), user_now, res.get("rates", {}), res.get("stale", False))
     await m.answer(text)
 
 
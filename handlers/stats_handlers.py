@@ -1,14 +1,20 @@
-import io
+from bisect import bisect_left
 from datetime import date, timedelta
-import matplotlib.pyplot as plt
 from aiogram import types
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types.input_file import BufferedInputFile
 import aiohttp
 
+from config import STATS_MA_HISTORY_DAYS
 from database import get_settings
 from api import fetch_historical_data
+from charts import (
+    ChartKey, ChartSpec, ChartBusyError, ChartTimeoutError,
+    chart_key, get_chart, get_chart_file_id, remember_chart_file_id, forget_chart_file_id,
+)
 from keyboards import build_stats_currencies_kb, build_stats_period_kb, main_menu
+from stats import summarize
+from utils import format_stats_summary
 
 
 async def handle_stats(m: types.Message):
@@ -74,6 +80,24 @@ async def cb_stats_period(cb: types.CallbackQuery):
     await cb.answer()
 
 
+async def _send_chart(message: types.Message, key: ChartKey, spec: ChartSpec, caption: str):
+    """Отправка графика: по file_id, если он уже загружался, иначе PNG из кеша или пула отрисовки"""
+    file_id = get_chart_file_id(key)
+    if file_id:
+        try:
+            await message.answer_photo(photo=file_id, caption=caption, reply_markup=main_menu())
+            return
+        except TelegramBadRequest:
+            forget_chart_file_id(key)
+
+    png = await get_chart(key, spec)
+    sent = await message.answer_photo(
+        photo=BufferedInputFile(png, filename="graph.png"), caption=caption, reply_markup=main_menu()
+    )
+    if sent.photo:
+        remember_chart_file_id(key, sent.photo[-1].file_id)
+
+
 async def cb_show_graph(cb: types.CallbackQuery):
     """Обработка построения графика статистики"""
     parts = cb.data.split(":")
@@ -112,41 +136,44 @@ async def cb_show_graph(cb: types.CallbackQuery):
     await cb.message.answer("📈 График строится, ожидайте...")
     
     try:
-        data = await fetch_historical_data(currency, start_date, end_date)
+        # Ряд загружается с историей до начала периода: по ней считаются MA7/MA30
+        data = await fetch_historical_data(
+            currency, start_date - timedelta(days=STATS_MA_HISTORY_DAYS), end_date
+        )
+        data.sort(key=lambda x: x[0])
+        history = bisect_left([d for d, _ in data], start_date)
         
-        if not data:
+        if history == len(data):
             await cb.message.answer(
                 f"❌ Данных за выбранный период для {currency} нет (возможно, выходные/праздники).",
                 reply_markup=main_menu()
             )
             return
         
-        data.sort(key=lambda x: x[0])
-        dates, values = zip(*data)
+        all_dates, all_values = zip(*data)
+        dates, values = all_dates[history:], all_values[history:]
         
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.plot(dates, values, marker="o", linewidth=2, markersize=4)
-        ax.set_title(
-            f"Курс {currency} к RUB за {days} дней\n"
-            f"(Данные ЦБ РФ, {start_date.strftime('%d.%m.%Y')} — {end_date.strftime('%d.%m.%Y')})",
-            fontsize=12
+        # Одинаковый период с теми же данными отдается из кеша; отрисовка - в пуле процессов
+        key = chart_key(currency, days, end_date, dates[-1])
+        spec = ChartSpec(
+            dates=tuple(dates),
+            values=tuple(values),
+            title=(
+                f"Курс {currency} к RUB за {days} дней\n"
+                f"(Данные ЦБ РФ, {start_date.strftime('%d.%m.%Y')} — {end_date.strftime('%d.%m.%Y')})"
+            ),
         )
-        ax.set_xlabel("Дата")
-        ax.set_ylabel("RUB")
-        ax.grid(True, linestyle="--", alpha=0.6)
-        ax.tick_params(axis='x', rotation=45)
-        plt.tight_layout(pad=1.0)
-        
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png", dpi=150, bbox_inches='tight')
-        buf.seek(0)
-        photo = BufferedInputFile(buf.getvalue(), filename="graph.png")
-        plt.close(fig)
-        
-        caption = f"📊 Динамика курса {currency} за {days} дней.\nТочки — ежедневные значения."
-        await cb.message.answer_photo(photo=photo, caption=caption, reply_markup=main_menu())
+        caption = (
+            f"📊 Динамика курса {currency} за {days} дней.\nТочки — ежедневные значения.\n\n"
+            f"{format_stats_summary(summarize(all_values, all_dates, history))}"
+        )
+        await _send_chart(cb.message, key, spec, caption)
         await cb.message.answer("✅ График отправлен!")
         
+    except ChartBusyError:
+        await cb.message.answer("⏳ Сейчас строится много графиков, попробуйте через минуту.", reply_markup=main_menu())
+    except ChartTimeoutError:
+        await cb.message.answer("❌ График не удалось построить вовремя, попробуйте позже.", reply_markup=main_menu())
     except ValueError as e:
         await cb.message.answer(f"⚠️ {str(e)}", reply_markup=main_menu())
     except aiohttp.ClientError as e:
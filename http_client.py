@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from metrics import UPSTREAM_SECONDS
+from config import (
+    UPSTREAM_RETRIES, UPSTREAM_BACKOFF_BASE, UPSTREAM_BACKOFF_MAX,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Глобальная сессия для переиспользования соединений
+_session: Optional[aiohttp.ClientSession] = None
+
+
+class UpstreamUnavailable(aiohttp.ClientConnectionError):
+    """Запрос не выполнялся: автомат защиты для этого хоста разомкнут"""
+
+
+class CircuitBreaker:
+    """Автомат защиты: после серии сбоев быстро отказывает, пока хост не восстановится
+
+    Состояния: closed (запросы идут), open (запросы сразу отклоняются),
+    half_open (по истечении BREAKER_RESET_TIMEOUT пропускается один пробный запрос).
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        """Можно ли выполнять запрос к хосту прямо сейчас"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        """Учет успешного ответа: автомат замыкается"""
+        if self.opened_at is not None:
+            logger.info(f"Circuit breaker for {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        """Учет сбоя: после failure_threshold сбоев подряд автомат размыкается"""
+        self.failures += 1
+        if self._probe_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+
+# Автоматы защиты по хостам (cbr-xml-daily.ru и cbr.ru отказывают независимо)
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    """Получение автомата защиты для хоста из URL"""
+    host = urlsplit(url).netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+
+
+def is_upstream_available(url: str) -> bool:
+    """Проверка, что автомат защиты для хоста не разомкнут"""
+    return get_breaker(url).state != "open"
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Получение или создание глобальной HTTP-сессии"""
+    global _session
+    if _session is None or _session.closed:
+        timeout = aiohttp.ClientTimeout(total=30)
+        headers = {"User-Agent": "ExchangeRateBot/1.0"}
+        _session = aiohttp.ClientSession(timeout=timeout, headers=headers)
+    return _session
+
+
+async def close_session():
+    """Закрытие глобальной HTTP-сессии"""
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+        _session = None
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Задержка перед повтором: экспоненциальная с полным джиттером"""
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+
+@asynccontextmanager
+async def request(url: str, timeout: float, retries: int = UPSTREAM_RETRIES,
+                  headers: Optional[Dict[str, str]] = None) -> AsyncIterator[aiohttp.ClientResponse]:
+    """GET-запрос с повторами, джиттером и автоматом защиты
+
+    Сетевые ошибки, таймауты и ответы 5xx повторяются до retries раз. Если повторы
+    исчерпаны, пробрасывается последняя ошибка (или отдается последний ответ 5xx).
+    Пока автомат защиты разомкнут, сразу выбрасывается UpstreamUnavailable.
+    """
+    breaker = get_breaker(url)
+    session = await get_session()
+    attempt = 0
+
+    while True:
+        if not breaker.allow_request():
+            raise UpstreamUnavailable(f"Upstream {breaker.name} is unavailable (circuit open)")
+
+        resp = None
+        started = time.perf_counter()
+        try:
+            resp = await session.get(url, timeout=aiohttp.ClientTimeout(total=timeout), headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            UPSTREAM_SECONDS.labels(breaker.name, type(e).__name__).observe(time.perf_counter() - started)
+            breaker.record_failure()
+            if attempt >= retries or breaker.state == "open":
+                raise
+            logger.warning(f"Request to {url} failed (attempt {attempt + 1}): {e!r}")
+        else:
+            UPSTREAM_SECONDS.labels(breaker.name, str(resp.status)).observe(time.perf_counter() - started)
+            if resp.status < 500:
+                breaker.record_success()
+                break
+            breaker.record_failure()
+            if attempt >= retries or breaker.state == "open":
+                break
+            logger.warning(f"Request to {url} returned status {resp.status} (attempt {attempt + 1})")
+            resp.release()
+
+        await asyncio.sleep(_backoff_delay(attempt))
+        attempt += 1
+
+    try:
+        yield resp
+    finally:
+        resp.release()
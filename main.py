@@ -2,40 +2,41 @@ import asyncio
 import logging
 import signal
 import sys
-from aiogram import Bot, Dispatcher
-from aiogram.filters import Command
-
-from config import BOT_TOKEN
-from database import init_db
-from scheduler import scheduler_loop
-from states import DateForm, InlineThresholdForm
-from api import close_session
-
-# Импорт обработчиков
-from handlers import basic, settings, thresholds, stats_handlers
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+from typing import TYPE_CHECKING, Optional
+
+from config import BOT_TOKEN, BOT_MODE, SCHEDULER_SHARDS
+
+if TYPE_CHECKING:
+    from aiogram import Bot, Dispatcher
 
 logger = logging.getLogger(__name__)
 
-# Инициализация бота и диспетчера
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
+# Бот и диспетчер создаются при запуске: импорт модуля (например, процессами отрисовки
+# графиков) не загружает aiogram, обработчики и клавиатуры
+bot: Optional["Bot"] = None
+dp: Optional["Dispatcher"] = None
+
+# Фоновые задачи (планировщик, обновление справочников) для корректного завершения
+background_tasks = []
+
 
-# Глобальная задача планировщика для корректного завершения
-scheduler_task = None
+def setup_logging():
+    """Настройка логирования"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('bot.log', encoding='utf-8'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
 
 
 def register_handlers():
-    """Регистрация всех обработчиков"""
+    """Регистрация всех обработчиков (модули обработчиков загружаются только в режиме бота)"""
+    from aiogram.filters import Command
+    from handlers import basic, settings, thresholds, stats_handlers
+    from states import DateForm, InlineThresholdForm
 
     # Базовые команды
     dp.message.register(basic.cmd_start, Command("start"))
@@ -93,49 +94,126 @@ async def shutdown(signal_name: str = None):
     else:
         logger.info("Shutting down...")
 
-    global scheduler_task
+    # Отмена фоновых задач
+    for task in background_tasks:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                logger.info(f"Background task {task.get_name()} cancelled")
+    background_tasks.clear()
 
-    # Отмена задачи планировщика
-    if scheduler_task and not scheduler_task.done():
-        scheduler_task.cancel()
-        try:
-            await scheduler_task
-        except asyncio.CancelledError:
-            logger.info("Scheduler task cancelled")
+    from api import close_session
+    from charts import shutdown_chart_pool
+    from database import close_db
+    from metrics import stop_metrics_server
+
+    # Остановка процессов отрисовки графиков
+    shutdown_chart_pool()
+
+    # Остановка эндпоинта метрик
+    await stop_metrics_server()
 
     # Закрытие HTTP-сессии
     await close_session()
     logger.info("HTTP session closed")
 
+    # Закрытие соединений с БД
+    await close_db()
+
     # Закрытие сессии бота
-    await bot.session.close()
-    logger.info("Bot session closed")
+    if bot is not None:
+        await bot.session.close()
+        logger.info("Bot session closed")
 
     logger.info("Shutdown complete")
 
 
-async def main():
-    """Основная функция запуска бота"""
-    global scheduler_task
+async def start_services(run_bot: bool, run_scheduler: bool):
+    """Инициализация БД, бота и фоновых задач; модули загружаются только для нужного режима"""
+    global bot, dp
+    from api import load_currency_directory, currency_directory_loop, rates_poller_loop
+    from database import init_db
+    from metrics import start_metrics_server
 
-    logger.info("Starting bot...")
+    # Инициализация БД
+    await init_db()
+    logger.info("Database initialized")
 
-    try:
-        # Инициализация БД
-        await init_db()
-        logger.info("Database initialized")
+    # Справочник валют из БД: первый график после рестарта не ждет ЦБ
+    await load_currency_directory()
+
+    logger.info(f"Running in {BOT_MODE} mode")
+
+    # Метрики планировщика, доставки и кешей (METRICS_PORT=0 - отключены)
+    await start_metrics_server()
+
+    if run_bot:
+        from aiogram import Bot, Dispatcher
+        from alerts import start_threshold_engine
+        from outbox import outbox_loop
+        from throttling import ThrottlingMiddleware
+
+        # Инициализация бота; все исходящие сообщения проходят через общий лимит скорости Telegram
+        bot = Bot(BOT_TOKEN)
+        bot.session.middleware(ThrottlingMiddleware())
+
+        # Индекс пороговых значений: оповещения отправляются при смене снимка курсов
+        await start_threshold_engine()
 
         # Регистрация обработчиков
+        dp = Dispatcher()
         register_handlers()
         logger.info("Handlers registered")
 
+        # Доставка уведомлений и оповещений из outbox (после рестарта продолжает очередь).
+        # Только в процессе бота: лимит TELEGRAM_RATE_LIMIT общий для ответов и рассылки,
+        # процессы планировщика лишь ставят сообщения в очередь
+        background_tasks.append(asyncio.create_task(outbox_loop(bot), name="outbox"))
+
+    if run_scheduler:
+        from prefetch import prefetch_loop
+        from scheduler import scheduler_loop
+        from sharding import ShardLeases
+
+        # Отдельные процессы планировщика (или SCHEDULER_SHARDS > 1) делят пользователей по арендам шардов
+        leases = None
+        if BOT_MODE == "scheduler" or SCHEDULER_SHARDS > 1:
+            leases = ShardLeases()
+            await leases.heartbeat()
+            background_tasks.append(asyncio.create_task(leases.run(), name="scheduler_leases"))
+
         # Запуск планировщика в фоне
-        scheduler_task = asyncio.create_task(scheduler_loop(bot))
+        background_tasks.append(asyncio.create_task(scheduler_loop(leases), name="scheduler"))
         logger.info("Scheduler started")
 
-        # Запуск polling
-        logger.info("Starting polling...")
-        await dp.start_polling(bot)
+        # Прогрев снимка курсов перед пиками рассылки
+        background_tasks.append(asyncio.create_task(prefetch_loop(), name="prefetch"))
+
+    # Фоновое обновление справочника валют и условный опрос текущих курсов
+    background_tasks.append(asyncio.create_task(currency_directory_loop(), name="currency_directory"))
+    background_tasks.append(asyncio.create_task(rates_poller_loop(), name="rates_poller"))
+
+
+async def main():
+    """Основная функция запуска бота"""
+    logger.info("Starting bot...")
+
+    try:
+        run_bot = BOT_MODE in ("all", "bot")
+        run_scheduler = BOT_MODE in ("all", "scheduler")
+        if not (run_bot or run_scheduler):
+            raise RuntimeError(f"Неизвестный BOT_MODE: {BOT_MODE} (ожидается all, bot или scheduler)")
+
+        await start_services(run_bot, run_scheduler)
+
+        if run_bot:
+            # Запуск polling
+            logger.info("Starting polling...")
+            await dp.start_polling(bot)
+        else:
+            await asyncio.gather(*background_tasks)
 
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received")
@@ -161,6 +239,8 @@ def handle_signal(signum, frame):
 
 
 if __name__ == "__main__":
+    setup_logging()
+
     # Регистрация обработчиков сигналов для Windows и Unix
     try:
         signal.signal(signal.SIGINT, handle_signal)
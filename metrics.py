@@ -0,0 +1,263 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config import METRICS_HOST, METRICS_PORT
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics: List["_Metric"] = []
+# Функции, обновляющие метрики перед выдачей (значения, которые считают другие модули)
+_collectors: List[Callable[[], Awaitable[None]]] = []
+_runner: Optional["web.AppRunner"] = None
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """Метрика в формате Prometheus с необязательными метками"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+        _metrics.append(self)
+
+    def labels(self, *values) -> "_Metric":
+        """Дочерняя метрика для набора значений меток"""
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {key}")
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self) -> "_Metric":
+        child = object.__new__(type(self))
+        child._init_value()
+        return child
+
+    def _samples(self) -> Iterator[Tuple[str, Sequence[str], str, float]]:
+        """(суффикс имени, значения меток, доп. метка, значение)"""
+        if self.labelnames:
+            for key, child in self._children.items():
+                for suffix, extra, value in child._values():
+                    yield suffix, key, extra, value
+        else:
+            for suffix, extra, value in self._values():
+                yield suffix, (), extra, value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._init_value()
+
+    def _init_value(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        """Установка значения счетчика, который ведется в другом модуле"""
+        self.value = value
+
+    def _values(self):
+        yield "", "", self.value
+
+
+class Gauge(Counter):
+    """Значение, которое может расти и уменьшаться"""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (задержки, длительности)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+        self._init_value()
+
+    def _new_child(self) -> "Histogram":
+        child = object.__new__(Histogram)
+        child.buckets = self.buckets
+        child._init_value()
+        return child
+
+    def _init_value(self):
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """Замер длительности блока"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def _values(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "_bucket", f'le="{_format_value(bound)}"', cumulative
+        yield "_sum", "", self.sum
+        yield "_count", "", cumulative
+
+
+def add_collector(collector: Callable[[], Awaitable[None]]):
+    """Регистрация функции, обновляющей метрики перед каждой выдачей"""
+    _collectors.append(collector)
+
+
+async def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logger.error(f"Metrics collector {collector.__name__} failed: {e}", exc_info=True)
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Планировщик
+SCHEDULER_TICK_SECONDS = Histogram("scheduler_tick_duration_seconds", "Duration of one scheduler check")
+SCHEDULER_LAG_SECONDS = Histogram(
+    "scheduler_lag_seconds", "Delay between the intended fire time and the scheduler check that enqueued it",
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900, 3600, 10800),
+)
+SCHEDULER_DUE_USERS = Gauge("scheduler_due_users", "Due users found by the last scheduler check")
+SCHEDULER_ENQUEUED = Counter("scheduler_notifications_enqueued_total", "Daily notifications enqueued to the outbox")
+SCHEDULER_MISSED = Counter("scheduler_notifications_missed_total", "Notifications skipped as too late to catch up")
+
+# Доставка через Telegram
+TELEGRAM_SEND_SECONDS = Histogram(
+    "telegram_send_duration_seconds", "Latency of outbox send_message calls, including rate limiting", ["kind"]
+)
+TELEGRAM_SENT = Counter("telegram_messages_sent_total", "Messages delivered from the outbox", ["kind"])
+TELEGRAM_ERRORS = Counter("telegram_errors_total", "Telegram API errors by exception type", ["type"])
+TELEGRAM_RATE_WAIT_SECONDS = Histogram(
+    "telegram_rate_limit_wait_seconds", "Time spent waiting for the Telegram rate limiter", ["priority"]
+)
+OUTBOX_MESSAGES = Gauge("outbox_messages", "Outbox messages by status", ["status"])
+OUTBOX_OLDEST_PENDING = Gauge("outbox_oldest_pending_age_seconds", "Age of the oldest pending outbox message")
+USERS = Gauge("users", "Users by state", ["state"])
+
+# Графики статистики
+CHART_RENDER_SECONDS = Histogram(
+    "chart_render_duration_seconds", "Chart render time in the process pool, including queueing", ["outcome"]
+)
+CHART_QUEUE = Gauge("chart_render_queue", "Chart renders running or waiting for a worker process")
+CHART_CACHE_EVENTS = Counter(
+    "chart_cache_events_total", "Chart requests by the tier that answered them (file_id, memory, disk, coalesced, render)", ["result"]
+)
+
+# Внешние API и кеши
+UPSTREAM_SECONDS = Histogram(
+    "upstream_request_duration_seconds", "Latency of rate provider HTTP attempts", ["host", "outcome"]
+)
+API_CACHE_EVENTS = Counter("api_cache_events_total", "api.py cache lookups by result", ["cache", "result"])
+API_CACHE_HIT_RATIO = Gauge("api_cache_hit_ratio", "Share of api.py cache lookups answered without a download", ["cache"])
+
+
+async def _start_server(host: str, port: int) -> "web.AppRunner":
+    # aiohttp.web загружается только при включенном эндпоинте (не в процессах отрисовки)
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        body = await render_metrics()
+        return web.Response(body=body.encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except BaseException:
+        await runner.cleanup()
+        raise
+    return runner
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Запуск HTTP-сервера метрик (GET /metrics); port=0 отключает сервер
+
+    Если порт занят (например, другим процессом на том же хосте), процесс
+    продолжает работу без эндпоинта метрик.
+    """
+    global _runner
+    if not port or _runner is not None:
+        return
+    try:
+        _runner = await _start_server(host, port)
+    except OSError as e:
+        logger.error(f"Metrics endpoint disabled: cannot listen on {host}:{port}: {e}")
+        return
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    """Остановка HTTP-сервера метрик"""
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
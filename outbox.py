@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramRetryAfter
+
+from config import (
+    NOTIFY_CONCURRENCY, OUTBOX_BATCH_SIZE, OUTBOX_SEND_LEASE, OUTBOX_POLL_INTERVAL,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, OUTBOX_RETENTION,
+)
+from database import (
+    add_listener, claim_outbox, complete_outbox, get_outbox_counts, prune_outbox,
+    deactivate_users, get_user_counts,
+)
+from metrics import (
+    add_collector, OUTBOX_MESSAGES, OUTBOX_OLDEST_PENDING, USERS,
+    TELEGRAM_ERRORS, TELEGRAM_SEND_SECONDS, TELEGRAM_SENT,
+)
+from throttling import bulk_priority
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, при которых повтор бессмысленен (бот заблокирован, чат не найден, текст отклонен)
+PERMANENT_ERRORS = (TelegramForbiddenError, TelegramNotFound, TelegramBadRequest)
+
+_wakeup: Optional[asyncio.Event] = None
+
+
+def is_chat_unreachable(error: Exception) -> bool:
+    """Бот заблокирован пользователем, чат удален или не найден"""
+    if isinstance(error, (TelegramForbiddenError, TelegramNotFound)):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+
+def _retry_delay(attempts: int) -> int:
+    """Задержка перед следующей попыткой: экспоненциальная от OUTBOX_RETRY_BASE"""
+    return min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** (attempts - 1))
+
+
+async def _collect_outbox_metrics():
+    """Глубина очереди и число пользователей для /metrics"""
+    counts = await get_outbox_counts()
+    OUTBOX_OLDEST_PENDING.set(counts.pop("oldest_pending_age", 0))
+    for status in ("pending", "sent", "failed", "expired"):
+        OUTBOX_MESSAGES.labels(status).set(counts.get(status, 0))
+    users = await get_user_counts()
+    USERS.labels("active").set(users["active"])
+    USERS.labels("inactive").set(users["inactive"])
+
+
+add_collector(_collect_outbox_metrics)
+
+
+async def _deliver_batch(bot: Bot, rows: List[Tuple]):
+    """Отправка забранных сообщений не более чем NOTIFY_CONCURRENCY одновременными запросами"""
+    now = int(time.time())
+    sent: List[int] = []
+    retry: List[Tuple[int, int, str]] = []
+    failed: List[Tuple[int, str, str]] = []
+    unreachable: List[int] = []
+    pending = iter(rows)
+
+    async def worker():
+        for message_id, user_id, kind, text, attempts, expires_at in pending:
+            if expires_at is not None and int(time.time()) > expires_at:
+                failed.append((message_id, "expired", "expired before delivery"))
+                continue
+            started = time.perf_counter()
+            try:
+                await bot.send_message(user_id, text)
+                sent.append(message_id)
+                TELEGRAM_SENT.labels(kind).inc()
+            except PERMANENT_ERRORS as e:
+                TELEGRAM_ERRORS.labels(type(e).__name__).inc()
+                logger.warning(f"Failed to send {kind} to user {user_id}: {e}")
+                failed.append((message_id, "failed", str(e)))
+                if is_chat_unreachable(e):
+                    unreachable.append(user_id)
+            except Exception as e:
+                # RetryAfter уже учтен в ThrottlingMiddleware
+                if not isinstance(e, TelegramRetryAfter):
+                    TELEGRAM_ERRORS.labels(type(e).__name__).inc()
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Giving up on {kind} for user {user_id} after {attempts} attempts: {e}")
+                    failed.append((message_id, "failed", str(e)))
+                else:
+                    delay = _retry_delay(attempts)
+                    logger.warning(f"Error sending {kind} to user {user_id} (attempt {attempts}), retry in {delay}s: {e}")
+                    retry.append((message_id, int(time.time()) + delay, str(e)))
+            finally:
+                TELEGRAM_SEND_SECONDS.labels(kind).observe(time.perf_counter() - started)
+
+    async def record():
+        await complete_outbox(sent, retry, failed, now)
+        if unreachable:
+            await deactivate_users(unreachable)
+
+    started = time.monotonic()
+    try:
+        # Рассылка идет с приоритетом ниже ответов пользователям (см. throttling.py)
+        with bulk_priority():
+            await asyncio.gather(*(worker() for _ in range(min(NOTIFY_CONCURRENCY, len(rows)))))
+    finally:
+        elapsed = time.monotonic() - started
+        # Результаты записываются и при отмене пачки (остановка процесса): иначе уже
+        # отправленные сообщения остались бы захваченными и ушли повторно после аренды
+        await asyncio.shield(record())
+    logger.info(
+        f"Outbox batch: {len(sent)} sent, {len(retry)} retry, {len(failed)} failed "
+        f"({len(unreachable)} unreachable chats) "
+        f"in {elapsed:.1f}s ({len(sent) / elapsed if elapsed else 0:.1f} msg/s)"
+    )
+
+
+async def outbox_loop(bot: Bot):
+    """Доставка сообщений из очереди outbox
+
+    Сообщения забираются пачками с арендой OUTBOX_SEND_LEASE: если процесс упал
+    во время отправки, после рестарта незавершенные сообщения будут забраны снова.
+    Временные ошибки повторяются с экспоненциальной задержкой.
+    """
+    global _wakeup
+    _wakeup = asyncio.Event()
+    add_listener("outbox_enqueued", lambda count: _wakeup.set())
+    last_prune = 0.0
+    try:
+        users = await get_user_counts()
+        logger.info(f"Outbox worker started: {users['active']} active users, {users['inactive']} deactivated chats")
+    except Exception:
+        logger.info("Outbox worker started")
+
+    while True:
+        try:
+            _wakeup.clear()
+            rows = await claim_outbox(int(time.time()), OUTBOX_BATCH_SIZE, OUTBOX_SEND_LEASE)
+            if rows:
+                await _deliver_batch(bot, rows)
+                continue
+
+            if time.monotonic() - last_prune > 3600:
+                pruned = await prune_outbox(int(time.time()) - OUTBOX_RETENTION)
+                if pruned:
+                    logger.info(f"Pruned {pruned} processed outbox messages")
+                last_prune = time.monotonic()
+
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        except asyncio.CancelledError:
+            logger.info("Outbox worker cancelled, shutting down")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error in outbox worker: {e}", exc_info=True)
+            await asyncio.sleep(5)
@@ -0,0 +1,76 @@
+import asyncio
+import calendar
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
+
+from api import warm_rates, refresh_rates
+from config import (
+    DEFAULT_CURRENCIES, CBR_TIMEZONE, CBR_PUBLICATION_WINDOW,
+    PREFETCH_LEAD_SECONDS, PREFETCH_INTERVAL, PREFETCH_AFTER_PUBLICATION_DELAY,
+)
+from database import get_upcoming_fires
+
+logger = logging.getLogger(__name__)
+
+
+async def _upcoming_busy_minutes(now: datetime, horizon: timedelta) -> Dict[datetime, Tuple[int, Set[str]]]:
+    """Минуты рассылки (UTC) в пределах horizon: число пользователей и нужные им валюты"""
+    busy: Dict[datetime, Tuple[int, Set[str]]] = {}
+    now_ts = calendar.timegm(now.timetuple())
+    for fire_ts, currencies, count in await get_upcoming_fires(now_ts - 60, now_ts + int(horizon.total_seconds())):
+        fire = datetime.utcfromtimestamp(fire_ts)
+        users, codes = busy.get(fire, (0, set()))
+        codes.update(c.strip().upper() for c in (currencies or DEFAULT_CURRENCIES).split(",") if c.strip())
+        busy[fire] = (users + count, codes)
+    return busy
+
+
+def _publication_refresh_time(now: datetime) -> Optional[datetime]:
+    """Момент (UTC) обновления снимка после сегодняшнего окна публикации ЦБ"""
+    msk_now = now + timedelta(hours=CBR_TIMEZONE)
+    if msk_now.isoweekday() > 5:
+        return None
+    window_end = msk_now.replace(hour=CBR_PUBLICATION_WINDOW[1], minute=0, second=0, microsecond=0)
+    return window_end - timedelta(hours=CBR_TIMEZONE) + timedelta(seconds=PREFETCH_AFTER_PUBLICATION_DELAY)
+
+
+async def prefetch_loop():
+    """Прогрев снимка курсов перед пиками рассылки и после окна публикации ЦБ"""
+    warmed: Set[datetime] = set()
+    last_publication_refresh = None
+    lead = timedelta(seconds=PREFETCH_LEAD_SECONDS)
+    horizon = lead + timedelta(seconds=PREFETCH_INTERVAL)
+
+    logger.info("Prefetcher started")
+
+    while True:
+        try:
+            now = datetime.utcnow()
+
+            publication_refresh = _publication_refresh_time(now)
+            if publication_refresh and now >= publication_refresh and last_publication_refresh != publication_refresh:
+                logger.info("Refreshing rates after CBR publication window")
+                await refresh_rates()
+                last_publication_refresh = publication_refresh
+
+            busy = await _upcoming_busy_minutes(now, horizon)
+            for fire, (users, currencies) in sorted(busy.items()):
+                if fire in warmed or fire - lead > now:
+                    continue
+                logger.info(
+                    f"Prefetching rates for {users} users due at UTC {fire.strftime('%H:%M')} "
+                    f"({len(currencies)} currencies)"
+                )
+                await warm_rates(fire + timedelta(minutes=1), currencies)
+                warmed.add(fire)
+
+            warmed = {fire for fire in warmed if fire >= now - timedelta(minutes=1)}
+            await asyncio.sleep(PREFETCH_INTERVAL)
+
+        except asyncio.CancelledError:
+            logger.info("Prefetcher cancelled, shutting down")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error in prefetcher: {e}", exc_info=True)
+            await asyncio.sleep(PREFETCH_INTERVAL)
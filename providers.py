@@ -0,0 +1,175 @@
+import logging
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import aiohttp
+
+from config import (
+    CBR_URL, CBR_ARCHIVE_URL, CBR_VALFULL_URL, CBR_DYNAMIC_URL,
+    UPSTREAM_TIMEOUT, UPSTREAM_XML_TIMEOUT,
+)
+from http_client import request, is_upstream_available
+
+logger = logging.getLogger(__name__)
+
+# Размер порции ответа, передаваемой потоковому XML-парсеру
+XML_CHUNK_SIZE = 64 * 1024
+
+
+class RateProvider(ABC):
+    """Источник курсов валют: текущие курсы, архив по датам, справочник и динамика
+
+    Провайдер отвечает только за транспорт и формат данных; кеширование,
+    объединение запросов и хранение выполняет модуль api. Провайдер без
+    какого-либо из абстрактных методов не создается (TypeError).
+    """
+
+    def is_available(self) -> bool:
+        """Можно ли сейчас обращаться к источнику (False - отдавать устаревший снимок)"""
+        return True
+
+    @abstractmethod
+    async def fetch_current(self, validators: Dict[str, str]) -> Tuple[Optional[Dict], Dict[str, str]]:
+        """Текущие курсы в формате daily_json и новые валидаторы (ETag / Last-Modified)
+
+        Если данные не изменились с момента получения validators, возвращается (None, validators).
+        """
+
+    @abstractmethod
+    async def fetch_archive(self, dt: date) -> Dict:
+        """Курсы (Valute в формате daily_json) за дату"""
+
+    @abstractmethod
+    def iter_directory(self) -> AsyncIterator[Tuple[str, str]]:
+        """Справочник валют: пары (ISO-код, ID)"""
+
+    @abstractmethod
+    def iter_dynamics(self, currency_id: str, start_date: date, end_date: date) -> AsyncIterator[Tuple[date, float]]:
+        """Динамика курса: пары (дата, курс за 1 единицу)"""
+
+
+async def _iter_xml_elements(resp: aiohttp.ClientResponse, tag: str) -> AsyncIterator[ET.Element]:
+    """Потоковый разбор XML-ответа: элементы tag выдаются по мере получения данных
+
+    Обработанные элементы удаляются из дерева, поэтому память не растет с размером ответа.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    try:
+        async for chunk in resp.content.iter_chunked(XML_CHUNK_SIZE):
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = elem
+                elif elem.tag == tag:
+                    yield elem
+                    root.clear()
+        parser.close()
+        for event, elem in parser.read_events():
+            if event == "end" and elem.tag == tag:
+                yield elem
+    except ET.ParseError as e:
+        logger.error(f"Invalid XML response from {resp.url}: {e}")
+        raise ValueError("Получен некорректный ответ от API")
+
+
+async def _iter_directory_items(resp: aiohttp.ClientResponse) -> AsyncIterator[Tuple[str, str]]:
+    """Потоковый разбор справочника валют: пары (ISO-код, ID)"""
+    async for item in _iter_xml_elements(resp, 'Item'):
+        char_code = item.findtext('ISO_Char_Code')
+        item_id = item.get('ID')
+        if char_code and item_id:
+            yield char_code.strip(), item_id
+
+
+async def _iter_dynamic_records(resp: aiohttp.ClientResponse) -> AsyncIterator[Tuple[date, float]]:
+    """Потоковый разбор динамики курса: пары (дата, курс за 1 единицу)"""
+    async for record in _iter_xml_elements(resp, 'Record'):
+        date_str = record.get('Date')
+        try:
+            nominal_text = record.findtext('Nominal')
+            value_text = record.findtext('Value')
+
+            if nominal_text is None or value_text is None:
+                continue
+
+            nominal = int(nominal_text)
+            value = float(value_text.replace(',', '.'))
+            dt = datetime.strptime(date_str, "%d.%m.%Y").date()
+            yield dt, value / nominal
+        except (AttributeError, ValueError, TypeError) as e:
+            logger.warning(f"Skipping invalid record for date {date_str}: {e}")
+            continue
+
+
+class CBRProvider(RateProvider):
+    """Провайдер данных ЦБ РФ (cbr-xml-daily.ru и cbr.ru) или совместимого сервера"""
+
+    def __init__(self, current_url: str = CBR_URL, archive_url: str = CBR_ARCHIVE_URL,
+                 valfull_url: str = CBR_VALFULL_URL, dynamic_url: str = CBR_DYNAMIC_URL):
+        self.current_url = current_url
+        self.archive_url = archive_url
+        self.valfull_url = valfull_url
+        self.dynamic_url = dynamic_url
+
+    def is_available(self) -> bool:
+        return is_upstream_available(self.current_url)
+
+    async def fetch_current(self, validators: Dict[str, str]) -> Tuple[Optional[Dict], Dict[str, str]]:
+        headers = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        async with request(self.current_url, timeout=UPSTREAM_TIMEOUT, headers=headers) as resp:
+            if resp.status == 304 and validators:
+                return None, validators
+
+            if resp.status != 200:
+                logger.error(f"CBR API returned status {resp.status}")
+                raise ValueError(f"API returned status {resp.status}")
+
+            data = await resp.json(content_type=None)
+            new_validators = {}
+            if resp.headers.get("ETag"):
+                new_validators["etag"] = resp.headers["ETag"]
+            if resp.headers.get("Last-Modified"):
+                new_validators["last_modified"] = resp.headers["Last-Modified"]
+            return data, new_validators
+
+    async def fetch_archive(self, dt: date) -> Dict:
+        url = self.archive_url.format(year=dt.year, month=dt.month, day=dt.day)
+        async with request(url, timeout=UPSTREAM_TIMEOUT) as resp:
+            if resp.status != 200:
+                logger.warning(f"No data for date {dt}: status {resp.status}")
+                raise ValueError("Нет данных за эту дату")
+            data = await resp.json(content_type=None)
+            return data["Valute"]
+
+    async def iter_directory(self) -> AsyncIterator[Tuple[str, str]]:
+        async with request(self.valfull_url, timeout=UPSTREAM_XML_TIMEOUT) as resp:
+            if resp.status != 200:
+                logger.error(f"Failed to fetch currency directory: status {resp.status}")
+                raise ValueError("Не удалось загрузить справочник валют")
+
+            async for item in _iter_directory_items(resp):
+                yield item
+
+    async def iter_dynamics(self, currency_id: str, start_date: date, end_date: date) -> AsyncIterator[Tuple[date, float]]:
+        url = (
+            f"{self.dynamic_url}?"
+            f"date_req1={start_date.strftime('%d/%m/%Y')}&"
+            f"date_req2={end_date.strftime('%d/%m/%Y')}&"
+            f"VAL_NM_RQ={currency_id}"
+        )
+        async with request(url, timeout=UPSTREAM_XML_TIMEOUT) as resp:
+            if resp.status != 200:
+                logger.error(f"Failed to fetch historical data: status {resp.status}")
+                raise ValueError("Не удалось загрузить исторические данные")
+
+            async for record in _iter_dynamic_records(resp):
+                yield record
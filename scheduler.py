@@ -1,141 +1,186 @@
 import asyncio
+import calendar
+import heapq
+import time
 from datetime import datetime, timedelta
-from aiogram import Bot
-from aiogram.exceptions import TelegramAPIError
+from typing import Dict, List, Mapping, Optional, Set, Tuple
 import logging
-from typing import Set, Tuple
 
-from database import get_all_users_settings, update_last_sent_date, get_user_thresholds
-from api import fetch_rates
-from utils import format_rates_for_user
-from config import DEFAULT_CURRENCIES, DEFAULT_WORKDAYS, DEFAULT_TIMEZONE
+from database import (
+    get_due_users, get_next_fire_time, queue_last_sent_date, flush_last_sent_dates, add_listener,
+    enqueue_outbox,
+)
+from api import fetch_rates_snapshot, select_rates
+from utils import format_rates_for_user, digest_key, next_fire_timestamp, parse_timezone
+from config import DEFAULT_CURRENCIES
+from sharding import ShardLeases
+from metrics import (
+    SCHEDULER_TICK_SECONDS, SCHEDULER_LAG_SECONDS, SCHEDULER_DUE_USERS, SCHEDULER_ENQUEUED, SCHEDULER_MISSED,
+)
 
 logger = logging.getLogger(__name__)
 
 # Константы
-SCHEDULER_POLL_INTERVAL = 60  # Интервал проверки в секундах (увеличен до 60 для избежания дубликатов)
+SCHEDULER_RESCAN_INTERVAL = 300  # Страховочная перепроверка БД (изменения из других процессов), секунды
+# В шардированном режиме расписание меняет процесс бота, поэтому БД перепроверяется каждую минуту
+SCHEDULER_SHARD_RESCAN_INTERVAL = 60
+NOTIFY_CATCHUP_WINDOW = 3 * 3600  # Пропущенные уведомления досылаются, если опоздание не больше этого
 
+# Очередь ближайших сроков уведомлений (Unix-время UTC) и событие досрочного пробуждения
+_deadlines: List[int] = []
+_deadline_set: Set[int] = set()
+_wakeup: Optional[asyncio.Event] = None
 
-async def scheduler_loop(bot: Bot):
-    """Планировщик для отправки уведомлений"""
-    # Множество для отслеживания уже отправленных уведомлений в текущей минуте
-    sent_this_minute: Set[Tuple[int, int, int]] = set()  # (user_id, hour, minute)
-    last_checked_minute = None
 
+def schedule_wakeup(fire_ts: Optional[int]):
+    """Добавление срока в очередь; если он раньше текущего ближайшего, планировщик просыпается"""
+    if fire_ts is None or fire_ts in _deadline_set:
+        return
+    earliest = _deadlines[0] if _deadlines else None
+    heapq.heappush(_deadlines, fire_ts)
+    _deadline_set.add(fire_ts)
+    if _wakeup is not None and (earliest is None or fire_ts < earliest):
+        _wakeup.set()
+
+
+def _pop_due_deadlines(now_ts: int):
+    """Удаление из очереди наступивших сроков"""
+    while _deadlines and _deadlines[0] <= now_ts:
+        _deadline_set.discard(heapq.heappop(_deadlines))
+
+
+async def _wait_for_deadline(rescan_interval: int = SCHEDULER_RESCAN_INTERVAL):
+    """Сон ровно до ближайшего срока (или до страховочной перепроверки), без накопления дрейфа"""
+    while True:
+        _wakeup.clear()
+        now = time.time()
+        # Перепроверка выровнена по границе интервала, а не отсчитывается от конца обработки
+        deadline = (int(now) // rescan_interval + 1) * rescan_interval
+        if _deadlines:
+            deadline = min(deadline, _deadlines[0])
+        delay = deadline - now
+        if delay <= 0:
+            return
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+def render_notification(currencies: str, user_now: datetime, snapshot: Optional[Mapping],
+                        digests: Optional[Dict[Tuple, str]] = None) -> str:
+    """Текст ежедневного уведомления по снимку курсов (пороговые значения проверяет alerts.py)
+
+    digests - общий для проверки планировщика кеш готовых текстов: пользователи
+    с одинаковым набором валют и местной минутой получают один и тот же текст.
+    """
+    currs = [c.strip().upper() for c in (currencies or DEFAULT_CURRENCIES).split(",") if c.strip()]
+    res = select_rates(snapshot, currs)
+    key = digest_key(currs, user_now, res)
+    text = digests.get(key) if digests is not None else None
+    if text is None:
+        text = format_rates_for_user(
+            res.get("base", "RUB"), user_now, res.get("rates", {}), res.get("stale", False)
+        )
+        if digests is not None:
+            digests[key] = text
+    return text
+
+
+async def _run_due(current_time: datetime, shards: Optional[Tuple[int, List[int]]] = None):
+    """Обработка пользователей с наступившим next_fire_utc, включая досылку пропущенных"""
+    now_ts = calendar.timegm(current_time.timetuple())
+
+    # Только пользователи с наступившим next_fire_utc (выборка по индексу), из своих шардов
+    rows = await get_due_users(now_ts, shards)
+    messages = []
+    # Отметки (user_id, last_sent_date, next_fire_utc) попадают в буфер записи только после outbox
+    markers: List[Tuple[int, Optional[str], Optional[int]]] = []
+    digests: Dict[Tuple, str] = {}
+    # Снимок курсов запрашивается один раз за проверку, при первом пользователе с уведомлением
+    snapshot: Optional[Mapping] = None
+    snapshot_loaded = False
+    SCHEDULER_DUE_USERS.set(len(rows))
+    if rows:
+        logger.info(f"Scheduler check: {len(rows)} due users at UTC {current_time.strftime('%H:%M:%S')}")
+
+    for user_id, currencies, notify_time, days, tz, last_sent, fire_ts in rows:
+        next_fire = next_fire_timestamp(notify_time, days, tz, current_time)
+        offset = timedelta(hours=parse_timezone(tz))
+        user_now = current_time + offset
+        # Уведомление относится к дню срока по местному времени пользователя
+        fire_iso = (datetime.utcfromtimestamp(fire_ts) + offset).date().isoformat()
+        lateness = now_ts - fire_ts
+
+        # Пропущенное уведомление досылается, пока не прошло окно и у пользователя тот же день
+        if lateness > NOTIFY_CATCHUP_WINDOW or fire_iso != user_now.date().isoformat():
+            logger.warning(f"Missed notification for user {user_id} (due {lateness}s ago), rescheduling")
+            SCHEDULER_MISSED.inc()
+            markers.append((user_id, last_sent, next_fire))
+            continue
+
+        # Проверка, что уведомление еще не отправлялось сегодня
+        if last_sent == fire_iso:
+            logger.info(f"Already sent notification today for user {user_id}")
+            markers.append((user_id, last_sent, next_fire))
+            continue
+
+        if lateness >= 60:
+            logger.info(f"Catching up notification for user {user_id}: {notify_time} ({lateness}s late)")
+        else:
+            logger.info(f"⏰ Time match for user {user_id}: {notify_time}")
+        # Задержка считается от точного времени проверки, а не от округленного now_ts
+        SCHEDULER_LAG_SECONDS.observe(max(0.0, time.time() - fire_ts))
+        if not snapshot_loaded:
+            snapshot = await fetch_rates_snapshot()
+            snapshot_loaded = True
+        text = render_notification(currencies, user_now, snapshot, digests)
+        # Ключ идемпотентности: одно уведомление на пользователя и день срока
+        messages.append((f"digest:{user_id}:{fire_iso}", user_id, "digest", text,
+                         fire_ts + NOTIFY_CATCHUP_WINDOW))
+        markers.append((user_id, fire_iso, next_fire))
+
+    # Сначала сообщения попадают в outbox, затем отметки об отправке - в буфер записи:
+    # если процесс упадет или остановится раньше, отметки не сохранятся и пользователи
+    # будут выбраны снова (повторная постановка отсеется по ключу идемпотентности)
+    if messages:
+        added = await enqueue_outbox(messages)
+        SCHEDULER_ENQUEUED.inc(added)
+        logger.info(f"Enqueued {added} notifications ({len(digests)} distinct digests)")
+    for user_id, last_sent, next_fire in markers:
+        await queue_last_sent_date(user_id, last_sent, next_fire)
+    await flush_last_sent_dates()
+
+
+async def scheduler_loop(leases: Optional[ShardLeases] = None):
+    """Планировщик уведомлений: ставит наступившие уведомления в outbox (доставляет outbox.py)
+
+    Просыпается ровно к ближайшему сроку из очереди; изменения расписания через
+    database.update_settings сразу добавляют срок в очередь. Сроки, пропущенные
+    из-за долгой обработки или перезапуска, выбираются следующей же проверкой.
+    С leases обрабатываются только пользователи арендованных шардов.
+    """
+    global _wakeup
+    _wakeup = asyncio.Event()
+    add_listener("schedule_changed", lambda user_id, fire_ts: schedule_wakeup(fire_ts))
+    rescan_interval = SCHEDULER_RESCAN_INTERVAL
+    if leases is not None:
+        leases.on_change = lambda: schedule_wakeup(int(time.time()))
+        rescan_interval = SCHEDULER_SHARD_RESCAN_INTERVAL
     logger.info("Scheduler started")
 
     while True:
         try:
             current_time = datetime.utcnow()
-            current_minute = (current_time.hour, current_time.minute)
-
-            # Сброс кеша при смене минуты
-            if current_minute != last_checked_minute:
-                sent_this_minute.clear()
-                last_checked_minute = current_minute
-
-            rows = await get_all_users_settings()
-            if rows:
-                logger.info(f"Scheduler check: {len(rows)} users at UTC {current_time.strftime('%H:%M:%S')}")
-
-            for row in rows:
-                user_id, currencies, notify_time, days, tz, last_sent = row
-
-                if not notify_time:
-                    continue
-
-                try:
-                    hh, mm = map(int, notify_time.split(":"))
-                    if not (0 <= hh <= 23 and 0 <= mm <= 59):
-                        logger.warning(f"Invalid time format for user {user_id}: {notify_time}")
-                        continue
-                except (ValueError, AttributeError) as e:
-                    logger.warning(f"Failed to parse notify_time for user {user_id}: {notify_time}, error: {e}")
-                    continue
-
-                try:
-                    tz = int(tz or DEFAULT_TIMEZONE)
-                    if not (-12 <= tz <= 14):
-                        logger.warning(f"Invalid timezone for user {user_id}: {tz}")
-                        tz = DEFAULT_TIMEZONE
-                except (ValueError, TypeError):
-                    tz = DEFAULT_TIMEZONE
-
-                user_now = datetime.utcnow() + timedelta(hours=tz)
-
-                # Проверка на уже отправленное уведомление в эту минуту
-                notification_key = (user_id, user_now.hour, user_now.minute)
-                if notification_key in sent_this_minute:
-                    continue
-
-                if user_now.hour == hh and user_now.minute == mm:
-                    logger.info(f"⏰ Time match for user {user_id}: {hh:02d}:{mm:02d}")
-                    daynum = user_now.isoweekday()
-
-                    try:
-                        allowed_days = [int(d) for d in (days or "").split(",") if d.strip().isdigit()] or DEFAULT_WORKDAYS
-                    except Exception as e:
-                        logger.warning(f"Failed to parse allowed days for user {user_id}: {e}")
-                        allowed_days = DEFAULT_WORKDAYS
-
-                    if daynum in allowed_days:
-                        today_iso = user_now.date().isoformat()
-
-                        # Проверка, что уведомление еще не отправлялось сегодня
-                        if last_sent == today_iso:
-                            logger.info(f"Already sent notification today for user {user_id}")
-                            continue
-
-                        # Отправка курсов валют
-                        try:
-                            currs = [c.strip().upper() for c in (currencies or DEFAULT_CURRENCIES).split(",") if c.strip()]
-                            res = await fetch_rates(currs)
-                            text = format_rates_for_user(res.get("base", "RUB"), user_now, res.get("rates", {}))
-
-                            await bot.send_message(user_id, text)
-                            logger.info(f"Sent rate notification to user {user_id}")
-                        except TelegramAPIError as e:
-                            logger.warning(f"Failed to send message to user {user_id}: {e}")
-                            # Пользователь мог заблокировать бота
-                            continue
-                        except Exception as e:
-                            logger.error(f"Error sending rates to user {user_id}: {e}", exc_info=True)
-                            continue
-
-                        # Проверка пороговых значений
-                        try:
-                            thresholds = await get_user_thresholds(user_id)
-
-                            if thresholds:
-                                res_all = await fetch_rates([t[1] for t in thresholds])
-
-                                for tid, c, tval, comm in thresholds:
-                                    data = res_all["rates"].get(c)
-                                    if not data or not data.get("value") or data.get("previous") is None:
-                                        continue
-
-                                    curr_val = data["value"]
-                                    prev_val = data["previous"]
-
-                                    # Проверка пересечения порога (только если пересекли, а не равны)
-                                    if (curr_val > tval >= prev_val) or (curr_val < tval <= prev_val):
-                                        text = f"⚠️ {c} достиг порогового значения {tval}!\nТекущий курс: {curr_val:.2f}"
-                                        if comm:
-                                            text += f"\nКомментарий: {comm}"
-                                        try:
-                                            await bot.send_message(user_id, text)
-                                            logger.info(f"Sent threshold alert to user {user_id} for {c}")
-                                        except TelegramAPIError as e:
-                                            logger.warning(f"Failed to send threshold alert to user {user_id}: {e}")
-                        except Exception as e:
-                            logger.error(f"Error checking thresholds for user {user_id}: {e}", exc_info=True)
-
-                        # Обновление даты последней отправки
-                        await update_last_sent_date(user_id, today_iso)
-                        # Отметка, что уведомление отправлено в эту минуту
-                        sent_this_minute.add(notification_key)
-
-            await asyncio.sleep(SCHEDULER_POLL_INTERVAL)
+            _pop_due_deadlines(calendar.timegm(current_time.timetuple()))
+
+            shards = leases.active() if leases is not None else None
+            if leases is None or shards is not None:
+                with SCHEDULER_TICK_SECONDS.time():
+                    await _run_due(current_time, shards)
+                schedule_wakeup(await get_next_fire_time(shards))
+
+            await _wait_for_deadline(rescan_interval)
 
         except asyncio.CancelledError:
             logger.info("Scheduler cancelled, shutting down")
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import SCHEDULER_SHARDS, SCHEDULER_WORKER_ID, SCHEDULER_LEASE_TTL, SCHEDULER_HEARTBEAT_INTERVAL
+from database import scheduler_heartbeat, acquire_shard_lease, release_shard_lease, remove_scheduler_worker
+
+logger = logging.getLogger(__name__)
+
+
+class ShardLeases:
+    """Аренда шардов пользователей (user_id % shard_count) планировщиком через таблицу scheduler_leases
+
+    Живые процессы отмечаются в scheduler_workers. Каждый процесс раз в heartbeat
+    продлевает свои аренды и забирает свободные или истекшие, пока у него меньше
+    справедливой доли (шарды / живые процессы); лишние отдает. Если процесс умер,
+    его аренды истекают через ttl и переходят к остальным.
+    """
+
+    def __init__(self, shard_count: int = SCHEDULER_SHARDS, worker_id: str = SCHEDULER_WORKER_ID,
+                 ttl: int = SCHEDULER_LEASE_TTL, heartbeat: int = SCHEDULER_HEARTBEAT_INTERVAL):
+        self.shard_count = shard_count
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat
+        # Шард -> время истечения аренды (Unix)
+        self._owned: Dict[int, int] = {}
+        # Вызывается при изменении набора своих шардов (планировщик сразу перепроверяет БД)
+        self.on_change: Optional[Callable[[], None]] = None
+
+    def active(self) -> Optional[Tuple[int, List[int]]]:
+        """Шарды, аренда которых еще действует: (число шардов, номера) или None, если шардов нет"""
+        # Запас в один heartbeat: не работаем с арендой, которую могли не успеть продлить
+        deadline = time.time() + self.heartbeat_interval
+        owned = sorted(shard for shard, expires_at in self._owned.items() if expires_at > deadline)
+        return (self.shard_count, owned) if owned else None
+
+    async def heartbeat(self):
+        """Продление своих аренд и перераспределение шардов"""
+        now = int(time.time())
+        leases, workers = await scheduler_heartbeat(self.worker_id, self.shard_count, now, self.ttl)
+        live_workers = set(workers) | {self.worker_id}
+        fair_share = math.ceil(self.shard_count / len(live_workers))
+        before = set(self._owned)
+
+        mine = [shard for shard, owner, expires_at in leases if owner == self.worker_id and expires_at >= now]
+        # Лишние шарды отдаем, чтобы их забрали новые процессы
+        for shard in mine[fair_share:]:
+            await release_shard_lease(shard, self.worker_id)
+            self._owned.pop(shard, None)
+        for shard in mine[:fair_share]:
+            if await acquire_shard_lease(shard, self.worker_id, now, self.ttl):
+                self._owned[shard] = now + self.ttl
+            else:
+                self._owned.pop(shard, None)
+
+        free = [shard for shard, owner, expires_at in leases if owner is None or expires_at < now]
+        for shard in free:
+            if len(self._owned) >= fair_share:
+                break
+            if await acquire_shard_lease(shard, self.worker_id, now, self.ttl):
+                self._owned[shard] = now + self.ttl
+
+        # Аренды, перехваченные другими процессами, пока мы не продлевали
+        for shard in set(self._owned) - set(mine) - set(free):
+            self._owned.pop(shard, None)
+
+        if set(self._owned) != before:
+            logger.info(f"Scheduler {self.worker_id} owns shards {sorted(self._owned)} of {self.shard_count}")
+            if self.on_change is not None:
+                self.on_change()
+
+    async def run(self):
+        """Периодическое продление аренд до отмены; при отмене аренды освобождаются"""
+        logger.info(f"Scheduler {self.worker_id} joining {self.shard_count} shards")
+        try:
+            while True:
+                try:
+                    await self.heartbeat()
+                except Exception as e:
+                    logger.error(f"Error renewing scheduler leases: {e}", exc_info=True)
+                await asyncio.sleep(self.heartbeat_interval)
+        except asyncio.CancelledError:
+            self._owned.clear()
+            try:
+                await remove_scheduler_worker(self.worker_id)
+            except Exception:
+                pass
+            raise
@@ -0,0 +1,122 @@
+from datetime import date
+from typing import NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+
+class SeriesStats(NamedTuple):
+    """Сводка по ряду курсов (проценты - в процентах, не в долях)"""
+    count: int
+    first: float
+    last: float
+    min: float
+    max: float
+    mean: float
+    change: float
+    change_pct: float
+    volatility_pct: float
+    max_drawdown_pct: float
+    ma7: Optional[float]
+    ma30: Optional[float]
+
+
+def as_array(values: Sequence[float]) -> np.ndarray:
+    """Ряд значений в виде массива float64"""
+    return np.asarray(values, dtype=np.float64)
+
+
+def day_numbers(dates: Sequence[date]) -> np.ndarray:
+    """Порядковые номера дней для дат ряда"""
+    return np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(dates))
+
+
+def moving_average(values: Sequence[float], window: int,
+                   dates: Union[Sequence[date], np.ndarray, None] = None) -> np.ndarray:
+    """Скользящее среднее
+
+    Без dates - по window последовательным значениям (len - window + 1 точек).
+    С dates (даты или номера дней из day_numbers) - по календарному окну: для каждой
+    точки среднее значений за window дней, заканчивающихся ее датой (курсы ЦБ есть
+    не за каждый день); точки, до которых ряд еще не покрывает полное окно, не возвращаются.
+    """
+    if window <= 0:
+        raise ValueError("Окно скользящего среднего должно быть положительным")
+    a = as_array(values)
+    # Через накопленную сумму: O(n) независимо от размера окна
+    csum = np.concatenate(([0.0], np.cumsum(a)))
+    if dates is None:
+        if len(a) < window:
+            return np.empty(0)
+        return (csum[window:] - csum[:-window]) / window
+
+    days = dates if isinstance(dates, np.ndarray) else day_numbers(dates)
+    if len(a) == 0:
+        return np.empty(0)
+    end = np.arange(1, len(a) + 1)
+    start = np.searchsorted(days, days - window + 1)
+    averages = (csum[end] - csum[start]) / (end - start)
+    return averages[days - days[0] + 1 >= window]
+
+
+def _last_average(a: np.ndarray, window: int, days: Optional[np.ndarray]) -> Optional[float]:
+    """Последнее значение скользящего среднего (как moving_average(...)[-1]) без расчета всего ряда"""
+    if days is None:
+        return float(a[-window:].mean()) if len(a) >= window else None
+    if days[-1] - days[0] + 1 < window:
+        return None
+    start = np.searchsorted(days, days[-1] - window + 1)
+    return float(a[start:].mean())
+
+
+def daily_returns(values: Sequence[float]) -> np.ndarray:
+    """Относительные изменения между соседними значениями ряда"""
+    a = as_array(values)
+    return np.diff(a) / a[:-1]
+
+
+def volatility(values: Sequence[float]) -> float:
+    """Дневная волатильность: выборочное стандартное отклонение дневных изменений"""
+    returns = daily_returns(values)
+    return float(returns.std(ddof=1)) if len(returns) > 1 else 0.0
+
+
+def max_drawdown(values: Sequence[float]) -> float:
+    """Максимальная просадка: наибольшее падение от предшествующего максимума, в долях"""
+    a = as_array(values)
+    if len(a) == 0:
+        return 0.0
+    peaks = np.maximum.accumulate(a)
+    return float(((peaks - a) / peaks).max())
+
+
+def summarize(values: Sequence[float], dates: Union[Sequence[date], np.ndarray, None] = None,
+              history: int = 0) -> SeriesStats:
+    """Сводка по ряду: минимум, максимум, среднее, изменение, волатильность, просадка и MA7/MA30
+
+    С dates (даты или номера дней) окна скользящих средних календарные (7 и 30 дней),
+    иначе - 7 и 30 значений. Первые history точек - история до периода: они участвуют
+    только в скользящих средних, чтобы MA30 была и у коротких периодов.
+    """
+    full = as_array(values)
+    a = full[history:]
+    if len(a) == 0:
+        raise ValueError("Нет данных для статистики")
+    first, last = float(a[0]), float(a[-1])
+    if dates is None:
+        days = None
+    else:
+        days = dates if isinstance(dates, np.ndarray) else day_numbers(dates)
+    return SeriesStats(
+        count=len(a),
+        first=first,
+        last=last,
+        min=float(a.min()),
+        max=float(a.max()),
+        mean=float(a.mean()),
+        change=last - first,
+        change_pct=(last - first) / first * 100 if first else 0.0,
+        volatility_pct=volatility(a) * 100,
+        max_drawdown_pct=max_drawdown(a) * 100,
+        ma7=_last_average(full, 7, days),
+        ma30=_last_average(full, 30, days),
+    )
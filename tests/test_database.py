@@ -0,0 +1,65 @@
+"""
+Дымовые тесты выборок планировщика (database.py)
+
+    python -m pytest -q tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import database  # noqa: E402
+
+NOW = 1_700_000_000
+# user_id -> next_fire_utc: 1-3 уже наступили, 4 - в будущем, 5 - без расписания
+FIRES = {1: NOW - 60, 2: NOW - 30, 3: NOW, 4: NOW + 600, 5: None}
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Выполнение запроса на новой базе с пользователями FIRES (в одном event loop с пулом)"""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+
+    def runner(query):
+        async def scenario():
+            await database.init_db()
+            try:
+                async with database._connection() as conn:
+                    await conn.executemany(
+                        "INSERT OR REPLACE INTO user_settings (user_id, next_fire_utc) VALUES (?, ?)", list(FIRES.items())
+                    )
+                    await conn.commit()
+                return await query()
+            finally:
+                await database.close_db()
+
+        return asyncio.run(scenario())
+
+    return runner
+
+
+def test_get_due_users(run):
+    rows = run(lambda: database.get_due_users(NOW))
+    assert [row[0] for row in rows] == [1, 2, 3]
+    assert rows[0][-1] == FIRES[1]
+
+
+def test_get_due_users_shards(run):
+    # user_id % 2: шард 1 - пользователи 1 и 3, шард 0 - пользователь 2
+    assert [row[0] for row in run(lambda: database.get_due_users(NOW, (2, [1])))] == [1, 3]
+    assert [row[0] for row in run(lambda: database.get_due_users(NOW, (2, [0])))] == [2]
+    assert [row[0] for row in run(lambda: database.get_due_users(NOW, (2, [0, 1])))] == [1, 2, 3]
+
+
+def test_get_next_fire_time(run):
+    assert run(database.get_next_fire_time) == FIRES[1]
+
+
+def test_get_next_fire_time_shards(run):
+    assert run(lambda: database.get_next_fire_time((2, [0]))) == FIRES[2]
+    assert run(lambda: database.get_next_fire_time((5, [4]))) == FIRES[4]
+    assert run(lambda: database.get_next_fire_time((7, [6]))) is None
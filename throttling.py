@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, Response
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_RATE_WAIT_SECONDS
+from config import (
+    TELEGRAM_RATE_LIMIT, TELEGRAM_RATE_BURST, TELEGRAM_CHAT_INTERVAL, TELEGRAM_RETRY_AFTER_ATTEMPTS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты отправки: ответы пользователю обслуживаются раньше массовой рассылки
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+_send_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def bulk_priority() -> Iterator[None]:
+    """Отправки внутри блока (и созданных в нем задач) идут с приоритетом рассылки"""
+    token = _send_priority.set(PRIORITY_BULK)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов с очередью ожидающих по приоритету
+
+    Токены пополняются со скоростью rate в секунду до capacity. Ожидающие
+    с меньшим значением приоритета получают токен первыми; pause() временно
+    останавливает выдачу (например, после ответа 429 от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _dispatch(self):
+        """Выдача токенов ожидающим; при нехватке - таймер до появления следующего"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if now < self.paused_until:
+                delay = self.paused_until - now
+                break
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                break
+            self.tokens -= 1
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        else:
+            return
+
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        """Ожидание токена"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._dispatch()
+        await future
+
+    def pause(self, seconds: float):
+        """Остановка выдачи токенов на seconds секунд"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self._dispatch()
+
+
+class ChatRateLimiter:
+    """Минимальный интервал между сообщениями в один чат"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot: Dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        """Ожидание своей очереди для чата"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+        if len(self._next_slot) > 10000:
+            self._next_slot = {cid: t for cid, t in self._next_slot.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, chat_id: int, seconds: float):
+        """Запрет сообщений в чат на seconds секунд"""
+        self._next_slot[chat_id] = max(self._next_slot.get(chat_id, 0.0), time.monotonic() + seconds)
+
+
+class ThrottlingMiddleware(BaseRequestMiddleware):
+    """Ограничение скорости исходящих сообщений бота под лимиты Telegram
+
+    Запросы, адресованные чату (send_message, edit_message_text и т.д.), проходят
+    через общее ведро токенов, рассылка (bulk_priority) - еще и через лимит чата:
+    серия ответов обработчика в один чат не разносится по интервалу. Остальные
+    запросы (getUpdates, answerCallbackQuery) не задерживаются. На ответ 429
+    отправка приостанавливается на retry_after и запрос повторяется.
+    """
+
+    def __init__(self, rate: float = TELEGRAM_RATE_LIMIT, burst: float = TELEGRAM_RATE_BURST,
+                 chat_interval: float = TELEGRAM_CHAT_INTERVAL,
+                 retry_attempts: int = TELEGRAM_RETRY_AFTER_ATTEMPTS):
+        self.bucket = TokenBucket(rate, burst)
+        self.chats = ChatRateLimiter(chat_interval)
+        self.retry_attempts = retry_attempts
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot,
+                       method: TelegramMethod) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = _send_priority.get()
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            if priority == PRIORITY_BULK and isinstance(chat_id, int):
+                await self.chats.acquire(chat_id)
+            await self.bucket.acquire(priority)
+            TELEGRAM_RATE_WAIT_SECONDS.labels(PRIORITY_NAMES[priority]).observe(time.perf_counter() - started)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                TELEGRAM_ERRORS.labels(type(e).__name__).inc()
+                if attempt >= self.retry_attempts:
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"Telegram flood control for chat {chat_id}: retry after {e.retry_after}s (attempt {attempt})"
+                )
+                # Пауза для всех отправок: иначе остальные запросы получат такой же 429
+                self.bucket.pause(e.retry_after)
+                if isinstance(chat_id, int):
+                    self.chats.pause(chat_id, e.retry_after)
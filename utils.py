@@ -1,6 +1,8 @@
-from datetime import datetime, date
-from typing import Dict, Optional, Union
-from config import CURRENCY_SYMBOLS
+import calendar
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+from config import CURRENCY_SYMBOLS, DEFAULT_TIMEZONE, DEFAULT_WORKDAYS
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,7 +23,77 @@ def calc_percent(current: float, threshold: float) -> str:
         return ""
 
 
-def format_rates_for_user(base: str, dt_obj: Union[datetime, date], rates: Dict[str, Optional[Dict]]) -> str:
+def parse_timezone(tz) -> int:
+    """Разбор часового пояса пользователя (смещение от UTC в часах)"""
+    try:
+        tz = int(tz or DEFAULT_TIMEZONE)
+        if not (-12 <= tz <= 14):
+            return DEFAULT_TIMEZONE
+        return tz
+    except (ValueError, TypeError):
+        return DEFAULT_TIMEZONE
+
+
+def parse_days(days: Optional[str]) -> List[int]:
+    """Разбор дней рассылки (1 - понедельник, 7 - воскресенье)"""
+    return [int(d) for d in (days or "").split(",") if d.strip().isdigit()] or DEFAULT_WORKDAYS
+
+
+def next_fire_time(notify_time: Optional[str], days: Optional[str], tz, after: datetime) -> Optional[datetime]:
+    """Ближайший момент уведомления (UTC) строго после after (UTC)"""
+    try:
+        hh, mm = map(int, (notify_time or "").split(":"))
+        if not (0 <= hh <= 23 and 0 <= mm <= 59):
+            return None
+    except (ValueError, AttributeError):
+        return None
+
+    offset = timedelta(hours=parse_timezone(tz))
+    allowed_days = parse_days(days)
+    local_after = after + offset
+    candidate = local_after.replace(hour=hh, minute=mm, second=0, microsecond=0)
+    if candidate <= local_after:
+        candidate += timedelta(days=1)
+    for _ in range(7):
+        if candidate.isoweekday() in allowed_days:
+            return candidate - offset
+        candidate += timedelta(days=1)
+    return None
+
+
+def next_fire_timestamp(notify_time: Optional[str], days: Optional[str], tz, after: datetime) -> Optional[int]:
+    """Ближайший момент уведомления строго после after (UTC) в секундах Unix"""
+    fire = next_fire_time(notify_time, days, tz, after)
+    return calendar.timegm(fire.timetuple()) if fire else None
+
+
+@lru_cache(maxsize=4096)
+def format_rate_line(code: str, base: str, value: Optional[float], nominal: int = 1,
+                     previous: Optional[float] = None) -> str:
+    """Строка курса одной валюты (кешируется: в одном снимке строки одинаковы для всех пользователей)"""
+    symbol = CURRENCY_SYMBOLS.get(code)
+    base_symbol = CURRENCY_SYMBOLS.get(base, base)
+    label = f"{code} ({symbol})" if symbol else code
+
+    if value is None:
+        return f"{label}: — {base_symbol}"
+
+    change_str = ""
+    if previous is not None and previous != 0:
+        try:
+            diff = ((value - previous) / previous) * 100
+            arrow = "📈" if diff > 0 else ("📉" if diff < 0 else "➖")
+            change_str = f" {arrow} {diff:+.2f}%"
+        except (ZeroDivisionError, TypeError):
+            pass
+
+    nominal_str = f" (за {nominal} шт)" if nominal != 1 else ""
+    return f"{label}: {value:.2f} {base_symbol}{nominal_str}{change_str}"
+
+
+def format_rates_for_user(
+    base: str, dt_obj: Union[datetime, date], rates: Dict[str, Optional[Dict]], stale: bool = False
+) -> str:
     """Форматирование курсов валют для пользователя"""
     if isinstance(dt_obj, datetime):
         dt_str = dt_obj.strftime('%d.%m.%Y %H:%M')
@@ -31,41 +103,57 @@ def format_rates_for_user(base: str, dt_obj: Union[datetime, date], rates: Dict[
         label = ""
 
     lines = [f"📊 Курсы валют на {dt_str}{label}", ""]
-    base_symbol = CURRENCY_SYMBOLS.get(base, base)
 
     for c, data in rates.items():
-        if data is None or data.get("value") is None:
-            symbol = CURRENCY_SYMBOLS.get(c)
-            if symbol:
-                lines.append(f"{c} ({symbol}): — {base_symbol}")
+        try:
+            if data is None:
+                lines.append(format_rate_line(c, base, None))
             else:
-                lines.append(f"{c}: — {base_symbol}")
-        else:
-            try:
-                value = data["value"]
-                nominal = data.get("nominal", 1)
-                prev = data.get("previous")
-                change_str = ""
-
-                if prev is not None and prev != 0:
-                    try:
-                        diff = ((value - prev) / prev) * 100
-                        arrow = "📈" if diff > 0 else ("📉" if diff < 0 else "➖")
-                        change_str = f" {arrow} {diff:+.2f}%"
-                    except (ZeroDivisionError, TypeError):
-                        pass
-
-                value_str = f"{value:.2f}"
-                nominal_str = f" (за {nominal} шт)" if nominal != 1 else ""
-                symbol = CURRENCY_SYMBOLS.get(c)
-
-                if symbol:
-                    lines.append(f"{c} ({symbol}): {value_str} {base_symbol}{nominal_str}{change_str}")
-                else:
-                    lines.append(f"{c}: {value_str} {base_symbol}{nominal_str}{change_str}")
-            except (KeyError, TypeError, ValueError) as e:
-                logger.warning(f"Error formatting rate for {c}: {e}")
-                lines.append(f"{c}: Ошибка данных")
+                lines.append(format_rate_line(
+                    c, base, data.get("value"), data.get("nominal", 1), data.get("previous")
+                ))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Error formatting rate for {c}: {e}")
+            lines.append(f"{c}: Ошибка данных")
 
     lines.append("")
+    if stale:
+        lines.append("⚠️ Сервис ЦБ сейчас недоступен, показаны последние полученные курсы.")
+    return "\n".join(lines)
+
+
+def digest_key(currencies: List[str], dt_obj: datetime, res: Dict) -> Tuple:
+    """Ключ готового текста рассылки: набор валют, локальная минута и значения курсов"""
+    rates = res.get("rates", {})
+    values = tuple(
+        (data.get("value"), data.get("nominal", 1), data.get("previous")) if data else None
+        for data in (rates.get(c) for c in currencies)
+    )
+    return tuple(currencies), dt_obj.strftime('%d.%m.%Y %H:%M'), res.get("base", "RUB"), values, res.get("stale", False)
+
+
+def _format_stat_value(value: float) -> str:
+    """Значение курса: мелкие курсы (за 1 единицу) - с четырьмя знаками"""
+    return f"{value:.2f}" if abs(value) >= 1 else f"{value:.4f}"
+
+
+def format_stats_summary(stats, base: str = "RUB") -> str:
+    """Текст сводки по ряду курсов (stats.SeriesStats)"""
+    base_symbol = CURRENCY_SYMBOLS.get(base, base)
+    arrow = "📈" if stats.change > 0 else ("📉" if stats.change < 0 else "➖")
+    lines = [
+        f"Мин: {_format_stat_value(stats.min)} {base_symbol} · "
+        f"Макс: {_format_stat_value(stats.max)} {base_symbol} · "
+        f"Среднее: {_format_stat_value(stats.mean)} {base_symbol}",
+        f"Изменение: {arrow} {'+' if stats.change > 0 else ''}{_format_stat_value(stats.change)} {base_symbol} "
+        f"({stats.change_pct:+.2f}%)",
+        f"Дневная волатильность: {stats.volatility_pct:.2f}%",
+        f"Макс. просадка: {stats.max_drawdown_pct:.2f}%",
+    ]
+    averages = [
+        f"{label}: {_format_stat_value(value)} {base_symbol}"
+        for label, value in (("MA7", stats.ma7), ("MA30", stats.ma30)) if value is not None
+    ]
+    if averages:
+        lines.append(" · ".join(averages))
     return "\n".join(lines)